@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of a spoonie sync. spotify web api, cover art cdn, librespot and the tonie cloud are replaced
+by local fakes, so no accounts are needed. Every playlist size runs in its own process (initial sync + a resync
+of the unchanged playlist) and reports wall time, request counts, peak RSS and the time `import spoonie` took.
+
+    python3 benchmark.py
+    python3 benchmark.py --tracks 100 --chunk-delay 5 -- --download-workers 4 --stream-encode
+
+Arguments after -- are passed to spoonie. Without ffmpeg the encode step is replaced by a file copy.
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import logging
+import uuid
+import shutil
+import resource
+import tempfile
+import threading
+import subprocess
+
+from argparse import ArgumentParser
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PLAYLIST_ID = "0benchmarkplaylist0000"
+HOUSEHOLD_NAME = "Benchmark"
+CREATIVE_TONIE_NAME = "Benchmark"
+LIBRESPOT_CHUNK_SIZE = 128 * 1024
+LIBRESPOT_HEADER_SIZE = 0xA7
+TRACKS_PER_ALBUM = 10
+
+def get_track_object(index, base_url, track_seconds) -> dict:
+    """ A spotify track object like the ones embedded in playlist pages """
+    album = index // TRACKS_PER_ALBUM
+    return {
+        "id": f"{index:022d}",
+        "type": "track",
+        "name": f"Track {index}",
+        "artists": [{"name": f"Artist {album}"}],
+        "album": {
+            "name": f"Album {album}",
+            "release_date": "2024-01-01",
+            "images": [{"url": f"{base_url}/image/{album}.jpg", "width": 640, "height": 640}],
+        },
+        "disc_number": 1,
+        "track_number": index % TRACKS_PER_ALBUM + 1,
+        "is_playable": True,
+        "duration_ms": track_seconds * 1000,
+    }
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    """ PLAYLISTS_URL / TRACKS_URL / SHOWS_URL endpoints, cover images and the tonie cloud file upload """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.count(re.sub(r'/[0-9a-zA-Z]{16,}(?=/|$)|/\d+\.jpg$', '/{id}', url.path))
+
+        if url.path.startswith("/image/"):
+            self.reply(self.server.image, "image/jpeg")
+        elif url.path == f"/v1/playlists/{PLAYLIST_ID}":
+            self.reply_json({"snapshot_id": "benchmark"})
+        elif url.path == f"/v1/playlists/{PLAYLIST_ID}/tracks":
+            offset = int(query.get("offset", ["0"])[0])
+            limit = int(query.get("limit", ["100"])[0])
+            self.reply_json({"total": len(self.server.tracks), "items": [{"track": track} for track in self.server.tracks[offset:offset + limit]]})
+        elif url.path == "/v1/tracks":
+            by_id = {track["id"]: track for track in self.server.tracks}
+            self.reply_json({"tracks": [by_id.get(track_id) for track_id in query["ids"][0].split(",")]})
+        elif url.path.startswith("/v1/shows/"):
+            if url.path.endswith("/episodes"):
+                self.reply_json({"items": []})
+            else:
+                self.reply_json({"name": "Benchmark show"})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self.server.count(self.path)
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, 1024 * 1024)))
+        self.send_response(204)
+        self.end_headers()
+
+    def reply_json(self, data):
+        self.reply(json.dumps(data).encode(), "application/json")
+
+    def reply(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeSpotifyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, track_count, track_seconds, image):
+        super().__init__(("127.0.0.1", 0), FakeSpotifyHandler)
+        self.base_url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.tracks = [get_track_object(i, self.base_url, track_seconds) for i in range(track_count)]
+        self.image = image
+        self.requests = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+class FakeChunkedStream:
+    """ read() / seek() like librespot's AbsChunkedInputStream, reads end at 128kB chunk boundaries """
+
+    def __init__(self, audio, chunk_delay):
+        self.audio = audio
+        self.chunk_delay = chunk_delay
+        # librespot's CdnFeedHelper skips the spotify header before returning the stream
+        self.position = LIBRESPOT_HEADER_SIZE
+
+    def pos(self):
+        return self.position
+
+    def seek(self, pos):
+        self.position = pos
+
+    def read(self, size):
+        end = min(self.position + size, (self.position // LIBRESPOT_CHUNK_SIZE + 1) * LIBRESPOT_CHUNK_SIZE, len(self.audio))
+        if self.chunk_delay > 0:
+            time.sleep(self.chunk_delay)
+        data = self.audio[self.position:end]
+        self.position = end
+        return data
+
+class FakeLibrespot:
+    """ Token provider and content feeder of a librespot session, serving the same audio for every track """
+
+    def __init__(self, audio, chunk_delay):
+        self.audio = os.urandom(LIBRESPOT_HEADER_SIZE) + audio
+        self.chunk_delay = chunk_delay
+        self.loads = 0
+        self.lock = threading.Lock()
+
+    def tokens(self):
+        return self
+
+    def get_token(self, *scopes):
+        return SimpleNamespace(access_token="benchmark", expires_in=3600, timestamp=time.time_ns() // 1000)
+
+    def content_feeder(self):
+        return self
+
+    def load(self, content_id, quality, preload, halt_listener):
+        with self.lock:
+            self.loads += 1
+        stream = FakeChunkedStream(self.audio, self.chunk_delay)
+        return SimpleNamespace(input_stream=SimpleNamespace(size=len(self.audio), stream=lambda: stream))
+
+class FakeTonieAPI:
+    """ In memory tonie cloud with one household and one (large) creative tonie, shared by all logins of a process """
+    requests = Counter()
+    lock = threading.Lock()
+    upload_url = None
+    seconds_remaining = 10 ** 7
+    household = None
+    creative_tonie = None
+
+    def __init__(self, username, password, timeout=30):
+        from tonie_api.models import CreativeTonie, Household
+        if FakeTonieAPI.creative_tonie is None:
+            FakeTonieAPI.household = Household(id="household", name=HOUSEHOLD_NAME, ownerName="benchmark", access="owner", canLeave=False)
+            FakeTonieAPI.creative_tonie = CreativeTonie(id="tonie", householdId="household", name=CREATIVE_TONIE_NAME, imageUrl="",
+                                                        secondsRemaining=FakeTonieAPI.seconds_remaining, secondsPresent=0, chaptersRemaining=10 ** 5,
+                                                        chaptersPresent=0, transcoding=False, lastUpdate=None, chapters=[])
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] += 1
+
+    def get_households(self):
+        self.count("get_households")
+        return [self.household]
+
+    def get_all_creative_tonies_by_household(self, household):
+        self.count("get_all_creative_tonies_by_household")
+        return [self.creative_tonie.model_copy(deep=True)]
+
+    def _post(self, path, data=None):
+        self.count(f"post {path}")
+        file_id = str(uuid.uuid4())
+        return {"request": {"url": FakeTonieAPI.upload_url, "fields": {"key": file_id}}, "fileId": file_id}
+
+    def add_chapter_to_tonie(self, creative_tonie, file_id, title):
+        from tonie_api.models import Chapter
+        self.count("add_chapter_to_tonie")
+        self.creative_tonie.chapters.append(Chapter(id=str(uuid.uuid4()), title=title, file=file_id, seconds=0, transcoding=False))
+
+    def sort_chapter_of_tonie(self, creative_tonie, sort_list):
+        self.count("sort_chapter_of_tonie")
+        FakeTonieAPI.creative_tonie.chapters = list(sort_list)
+
+def create_sample_audio(track_seconds, data_path) -> tuple[bytes, bool]:
+    """ Ogg Vorbis test tone via ffmpeg, or random bytes (and no real encode) if ffmpeg is missing """
+    if shutil.which("ffmpeg") is None:
+        return os.urandom(track_seconds * 20000), False
+    sample_file = os.path.join(data_path, "sample.ogg")
+    subprocess.run(["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={track_seconds}",
+                    "-c:a", "libvorbis", "-q:a", "5", sample_file], check=True)
+    with open(sample_file, "rb") as f:
+        return f.read(), True
+
+def create_sample_image() -> bytes:
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new("RGB", (640, 640), (200, 120, 40)).save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+def run_child(track_count, options, spoonie_args) -> list[dict]:
+    """ Runs an initial sync and a resync of a track_count playlist against the fakes, inside this process """
+    data_path = tempfile.mkdtemp(prefix="spoonie-benchmark-")
+    try:
+        open(os.path.join(data_path, "credentials.json"), "w").close()
+        audio, has_ffmpeg = create_sample_audio(options.track_seconds, data_path)
+        server = FakeSpotifyServer(track_count, options.track_seconds, create_sample_image())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s | %(message)s')
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        time_start = time.perf_counter()
+        import spoonie
+        import_seconds = time.perf_counter() - time_start
+        config = spoonie.parse_args(["-tu", "benchmark", "-tp", "benchmark", "-th", HOUSEHOLD_NAME, "-ctn", CREATIVE_TONIE_NAME,
+                                     "-P", f"https://open.spotify.com/playlist/{PLAYLIST_ID}", "-d", data_path] + spoonie_args)
+
+        class BenchmarkSync(spoonie.SpoonieSync):
+            def create_tonie_api(self):
+                return FakeTonieAPI(config.tonie_username, config.tonie_password, config.tonie_timeout)
+
+        spoonie.PLAYLISTS_URL = f"{server.base_url}/v1/playlists"
+        spoonie.TRACKS_URL = f"{server.base_url}/v1/tracks"
+        spoonie.SHOWS_URL = f"{server.base_url}/v1/shows"
+        spoonie.EPISODE_INFO_URL = f"{server.base_url}/v1/episodes"
+        librespot = FakeLibrespot(audio, options.chunk_delay / 1000)
+        spoonie.SpotifySession.librespot = lambda self: librespot
+        FakeTonieAPI.upload_url = f"{server.base_url}/upload"
+        if options.tonie_minutes > 0:
+            FakeTonieAPI.seconds_remaining = options.tonie_minutes * 60
+        if not has_ffmpeg:
+            spoonie.convert_audio_format = lambda temp_filename, filename, tags=None, artwork_file=None: shutil.copyfile(temp_filename, filename)
+
+        results = []
+        for run in ("initial", "resync"):
+            server.requests.clear()
+            FakeTonieAPI.requests.clear()
+            librespot.loads = 0
+            time_start = time.perf_counter()
+            try:
+                failed = len(BenchmarkSync(config).run()) > 0
+            except Exception:
+                logging.exception(f"{run} run failed")
+                failed = True
+            wall_seconds = time.perf_counter() - time_start
+            with open(os.path.join(data_path, spoonie.RUN_SUMMARY_FILENAME)) as f:
+                summary = json.load(f)
+            results.append({
+                "tracks": track_count,
+                "run": run,
+                "failed": failed,
+                "wall_seconds": wall_seconds,
+                "import_seconds": import_seconds,
+                "spotify_requests": sum(count for endpoint, count in server.requests.items() if endpoint.startswith("/v1/")),
+                "image_requests": server.requests["/image/{id}"],
+                "librespot_loads": librespot.loads,
+                "tonie_requests": sum(FakeTonieAPI.requests.values()) + server.requests["/upload"],
+                "chapters": len(FakeTonieAPI.creative_tonie.chapters),
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+                "encoded": has_ffmpeg,
+                "phases": {name: round(stats["seconds"], 3) for name, stats in summary["phases"].items()},
+                "requests": dict(server.requests) | {f"tonie {name}": count for name, count in FakeTonieAPI.requests.items()},
+            })
+        return results
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+
+def print_results(results) -> None:
+    print(f"{'tracks':>7} {'run':>8} {'wall s':>8} {'spotify':>8} {'images':>7} {'librespot':>10} {'tonie':>6} {'chapters':>9} {'rss MB':>7} {'import s':>9}")
+    for r in results:
+        print(f"{r['tracks']:>7} {r['run']:>8} {r['wall_seconds']:>8.2f} {r['spotify_requests']:>8} {r['image_requests']:>7} "
+              f"{r['librespot_loads']:>10} {r['tonie_requests']:>6} {r['chapters']:>9} {r['peak_rss_mb']:>7.1f} {r['import_seconds']:>9.3f}{'  FAILED' if r['failed'] else ''}")
+        print(f"{'':>16} phases: {', '.join(f'{name} {seconds:.2f}s' for name, seconds in r['phases'].items())}")
+    if len(results) > 0 and not results[0]["encoded"]:
+        print("ffmpeg not found => encode replaced by a file copy")
+
+def main():
+    parser = ArgumentParser(description="Offline spoonie sync benchmark")
+    parser.add_argument("-t", "--tracks", nargs="+", type=int, default=[10, 100, 1000], help="Playlist sizes to benchmark")
+    parser.add_argument("-ts", "--track-seconds", type=int, default=30, help="Length of the synthetic tracks")
+    parser.add_argument("-cd", "--chunk-delay", type=float, default=0, help="Simulated librespot latency per 128kB chunk in ms")
+    parser.add_argument("-tm", "--tonie-minutes", type=int, default=0, help="Free minutes on the creative tonie (0 = unlimited)")
+    parser.add_argument("-o", "--output", default=None, help="Also write the results as JSON to this file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show the spoonie log")
+    parser.add_argument("--child", type=int, default=None, help="(internal) run one playlist size in this process")
+    parser.add_argument("--result-file", default=None, help="(internal) result file of a child run")
+    argv = sys.argv[1:]
+    spoonie_args = []
+    if "--" in argv:
+        spoonie_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    options = parser.parse_args(argv)
+
+    if options.child is not None:
+        results = run_child(options.child, options, spoonie_args)
+        with open(options.result_file, "w") as f:
+            json.dump(results, f)
+        return
+
+    results = []
+    for track_count in options.tracks:
+        with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+            command = [sys.executable, os.path.abspath(__file__), "--child", str(track_count), "--result-file", result_file.name,
+                       "--track-seconds", str(options.track_seconds), "--chunk-delay", str(options.chunk_delay),
+                       "--tonie-minutes", str(options.tonie_minutes), "--"] + spoonie_args
+            subprocess.run(command, check=True, stdout=None if options.verbose else subprocess.DEVNULL)
+            results += json.load(result_file)
+
+    print_results(results)
+    if options.output is not None:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
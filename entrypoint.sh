@@ -1,5 +1,12 @@
 #!/bin/bash
 printenv > /etc/environment
+if [ "$DAEMON" = "true" ]; then
+    echo "############### Starting daemon... ###############"
+    exec /usr/local/bin/python3 /app/spoonie.py --spotify-user "$SPOTIFY_USERNAME" --spotify-password "$SPOTIFY_PASSWORD" \
+        --tonie-username "$TONIE_USERNAME" --tonie-password "$TONIE_PASSWORD" --tonie-household "$TONIE_HOUSEHOLD" \
+        --creative-tonie "$CREATIVE_TONIE" --tonie-timeout $TONIE_TIMEOUT --playlist "$PLAYLIST" --data-path "$DATA_PATH" \
+        --daemon --interval $SYNC_INTERVAL
+fi
 echo "############### Starting initial run... ###############"
 /usr/local/bin/python3 /app/spoonie.py --spotify-user "$SPOTIFY_USERNAME" --spotify-password "$SPOTIFY_PASSWORD" \
         --tonie-username "$TONIE_USERNAME" --tonie-password "$TONIE_PASSWORD" --tonie-household "$TONIE_HOUSEHOLD" \
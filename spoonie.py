@@ -8,44 +8,135 @@ import os
 import sys
 import time
 import math
-import music_tag
 import tempfile
-import ffmpy
-
-from typing import Optional, Tuple
+import sqlite3
+import hashlib
+import threading
+import functools
+import contextlib
+import itertools
+import subprocess
+import mimetypes
+import random
+import glob
+import signal
+
+from typing import TYPE_CHECKING, Iterator, Optional, Tuple
+from dataclasses import dataclass, replace
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
 from pathlib import Path
-from librespot.audio.decoders import VorbisOnlyAudioQuality
-from librespot.metadata import TrackId,EpisodeId
-from librespot.audio.decoders import AudioQuality, VorbisOnlyAudioQuality
-from librespot.core import Session
-from tonie_api.api import TonieAPI
-from tonie_api.models import Config, CreativeTonie, User
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from argparse import ArgumentParser, Namespace
 
-from argparse import ArgumentParser
+# librespot, ffmpy and tonie_api are imported where they are needed, a run without changes never loads librespot and ffmpy
+if TYPE_CHECKING:
+    from librespot.core import Session
+    from tonie_api.api import TonieAPI
+    from tonie_api.models import Chapter, CreativeTonie
 
 PLAYLISTS_URL = 'https://api.spotify.com/v1/playlists'
 TRACKS_URL = 'https://api.spotify.com/v1/tracks'
 EPISODE_INFO_URL = 'https://api.spotify.com/v1/episodes'
 SHOWS_URL = 'https://api.spotify.com/v1/shows'
 
+TRACKS_BATCH_SIZE = 50
+PLAYLIST_PAGE_SIZE = 100
+PLAYLIST_PAGE_WORKERS = 4
+PLAYLIST_ITEM_FIELDS = 'total,items(track(id,type,name,is_playable,duration_ms,disc_number,track_number,artists(name),album(name,release_date,images(url,width))))'
+STATE_DB_FILENAME = 'state.db'
+ARTWORK_CACHE_FOLDER = 'artwork'
+TOKEN_FILENAME = 'token.json'
+PARTIAL_FOLDER = 'partial'
+MIN_BYTES_PER_SECOND = 4000
+SYNC_REFERENCE_DAYS = 30
+STORE_TEMP_SUFFIXES = ('.part', '.part.json', '.download')
+STORE_LAYOUT_VERSION = 1
+LEGACY_ID_PREFIX = 'legacy:'
+TOKEN_REFRESH_MARGIN = 60
+PODCAST_CHUNK_SIZE = 8 * 1024 * 1024
+PODCAST_PARALLEL_THRESHOLD = 32 * 1024 * 1024
+STREAM_MIN_READ_SIZE = 128 * 1024
+STREAM_MAX_READ_SIZE = 1024 * 1024
+STREAM_WRITE_BUFFER_SIZE = 1024 * 1024
+RUN_SUMMARY_FILENAME = 'run_summary.json'
+SPOTIFY_SCOPES = ("user-read-email", "playlist-read-private", "user-library-read", "user-follow-read")
+
 usage = """
 """.format(sys.version, os.path.basename(__file__))
 
 parser = ArgumentParser(usage=usage)
 parser.add_argument("-su", "--spotify-username", dest="spotify_username", required=False, help="", deprecated=True)
 parser.add_argument("-sp", "--spotify-password", dest="spotify_password", required=False, help="", deprecated=True)
-parser.add_argument("-tu", "--tonie-username", dest="tonie_username", required=True, help="")
-parser.add_argument("-tp", "--tonie-password", dest="tonie_password", required=True, help="")
-parser.add_argument("-th", "--tonie-household", dest="tonie_household", required=True, help="Name of the 'meine Tonies' Haushalt")
-parser.add_argument("-ctn", "--creative-tonie", dest="creative_tonie_name", required=True, help="Name of the creative tonie")
+parser.add_argument("-tu", "--tonie-username", dest="tonie_username", required=False, help="")
+parser.add_argument("-tp", "--tonie-password", dest="tonie_password", required=False, help="")
+parser.add_argument("-th", "--tonie-household", dest="tonie_household", required=False, help="Name of the 'meine Tonies' Haushalt")
+parser.add_argument("-ctn", "--creative-tonie", dest="creative_tonie_name", required=False, help="Name of the creative tonie")
 parser.add_argument("-tt", "--tonie-timeout", default=30,type=int, dest="tonie_timeout", required=False, help="Set timeout for tonieapi (which is quite slow sometimes)")
-parser.add_argument("-P", "--playlist", dest="playlist", required=True, help="Link of a Spotify playlist or a show/podcast")
+parser.add_argument("-P", "--playlist", dest="playlist", required=False, help="Link of a Spotify playlist or a show/podcast")
+parser.add_argument("-C", "--config", dest="config", required=False, help="JSON file with several playlist/show => creative tonie syncs (instead of -th, -ctn and -P)")
 parser.add_argument("-d", "--data-path", dest="data_path", required=False, help="Defaults to ~/.local/share/spoonie")
 parser.add_argument("-b", "--ban-protection", action="store_true", dest="ban_protection", required=False, help="Ban protection")
-
-args = parser.parse_args()
-
-logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s | %(message)s' )
+parser.add_argument("-bbs", "--ban-bytes-per-second", default=200000, type=int, dest="ban_bytes_per_second", required=False, help="Ban protection: download bandwidth shared by all downloads")
+parser.add_argument("-bth", "--ban-tracks-per-hour", default=120, type=int, dest="ban_tracks_per_hour", required=False, help="Ban protection: max downloaded tracks per hour (across runs)")
+parser.add_argument("-btd", "--ban-tracks-per-day", default=1000, type=int, dest="ban_tracks_per_day", required=False, help="Ban protection: max downloaded tracks per day (across runs)")
+parser.add_argument("-se", "--stream-encode", action="store_true", dest="stream_encode", required=False, help="Pipe the downloaded audio straight into ffmpeg instead of using a temp file")
+parser.add_argument("-acs", "--artwork-cache-size", default=50, type=int, dest="artwork_cache_size", required=False, help="Max size of the cover artwork cache in MB")
+parser.add_argument("-as", "--artwork-size", default=300, type=int, dest="artwork_size", required=False, help="Downscale cover artwork to this many pixels (0 keeps the original)")
+parser.add_argument("-aq", "--artwork-quality", default=80, type=int, dest="artwork_quality", required=False, help="JPEG quality of downscaled cover artwork")
+parser.add_argument("-uw", "--upload-workers", default=2, type=int, dest="upload_workers", required=False, help="Number of concurrent creative tonie uploads")
+parser.add_argument("-ur", "--upload-retries", default=3, type=int, dest="upload_retries", required=False, help="Number of attempts per creative tonie upload")
+parser.add_argument("-n", "--dry-run", action="store_true", dest="dry_run", required=False, help="Only print the planned creative tonie changes")
+parser.add_argument("-ar", "--api-rate", default=10.0, type=float, dest="api_rate", required=False, help="Max spotify api requests per second")
+parser.add_argument("-le", "--latest-episodes", default=None, type=int, dest="latest_episodes", required=False, help="Only sync the latest N episodes of a show")
+parser.add_argument("-pw", "--podcast-workers", default=4, type=int, dest="podcast_workers", required=False, help="Number of parallel byte ranges for large direct podcast downloads")
+parser.add_argument("-dw", "--download-workers", default=1, type=int, dest="download_workers", required=False, help="Number of concurrent spotify downloads")
+parser.add_argument("-ew", "--encode-workers", default=2, type=int, dest="encode_workers", required=False, help="Number of concurrent ffmpeg encodes")
+parser.add_argument("-D", "--daemon", action="store_true", dest="daemon", required=False, help="Keep running and sync whenever a playlist changed (instead of one sync per start)")
+parser.add_argument("-i", "--interval", default=900, type=int, dest="interval", required=False, help="Daemon: seconds between two checks for changes")
+parser.add_argument("-ij", "--interval-jitter", default=60, type=int, dest="interval_jitter", required=False, help="Daemon: random +/- seconds added to the interval")
+parser.add_argument("-tP", "--trigger-port", default=None, type=int, dest="trigger_port", required=False, help="Daemon: start a sync on POST http://127.0.0.1:<port>/sync (SIGUSR1 works as well)")
+parser.add_argument("-pm", "--prometheus-file", default=None, dest="prometheus_file", required=False, help="Write prometheus text metrics of each run to this file (e.g. for the node_exporter textfile collector)")
+parser.add_argument("-ep", "--encode-profile", default="mp3", choices=["mp3", "mp3-mono", "passthrough"], dest="encode_profile", required=False, help="mp3: 160k stereo mp3 (default), mp3-mono: 96k mono mp3 (smaller uploads), passthrough: keep spotify's ogg vorbis without transcoding")
+parser.add_argument("-eb", "--encode-bitrate", default=None, dest="encode_bitrate", required=False, help="Override the bitrate of the encode profile, e.g. 128k")
+parser.add_argument("-ec", "--encode-channels", default=None, type=int, dest="encode_channels", required=False, help="Override the number of channels of the encode profile (1 = mono)")
+parser.add_argument("-esr", "--encode-sample-rate", default=None, type=int, dest="encode_sample_rate", required=False, help="Override the sample rate of the encode profile, e.g. 44100")
+parser.add_argument("-ft", "--ffmpeg-threads", default=None, type=int, dest="ffmpeg_threads", required=False, help="Threads per ffmpeg process (see --encode-workers for the number of processes)")
+parser.add_argument("-dq", "--download-quota", default=1000, type=int, dest="download_quota", required=False, help="Max size of the download folder in MB, files no longer on any playlist are removed above it (0 removes them right away)")
+parser.add_argument("-aw", "--artwork-workers", default=4, type=int, dest="artwork_workers", required=False, help="Number of concurrent artwork downloads")
+
+# config of the running SpoonieSync (see create_config / parse_args)
+args = None
+
+def validate_config(config) -> Optional[str]:
+    """ Returns what is missing in a config (None if it is complete) """
+    if config.tonie_username is None or config.tonie_password is None:
+        return "--tonie-username and --tonie-password are required"
+    if config.config is None and None in (config.tonie_household, config.creative_tonie_name, config.playlist):
+        return "either --config or --tonie-household, --creative-tonie and --playlist are required"
+    return None
+
+def parse_args(argv=None) -> Namespace:
+    """ Config from the command line (sys.argv by default), exits with the usage on errors """
+    config = parser.parse_args(argv)
+    error = validate_config(config)
+    if error is not None:
+        parser.error(error)
+    return config
+
+def create_config(**options) -> Namespace:
+    """ Config for using spoonie as a library: the command line defaults updated with options (named like the dest of the option) """
+    config = parser.parse_args([])
+    for name, value in options.items():
+        if not hasattr(config, name):
+            raise TypeError(f"Unknown option '{name}'")
+        setattr(config, name, value)
+    error = validate_config(config)
+    if error is not None:
+        raise ValueError(error)
+    return config
 
 def fix_filename(name):
     """
@@ -153,82 +244,395 @@ def regex_input_for_urls(search_input) -> tuple[str, str, str, str, str, str]:
 
     return track_id_str, album_id_str, playlist_id_str, episode_id_str, show_id_str, artist_id_str
 
-def get_episode_info(spotifySession,episode_id_str) -> Tuple[Optional[str], Optional[str]]:
+def get_episode_info(spotifySession,state,episode_id_str) -> Tuple[Optional[str], Optional[str]]:
 
-    (raw, info) = invoke_url(spotifySession,f'{EPISODE_INFO_URL}/{episode_id_str}')
+    known_episode = state.get_episode(episode_id_str)
+    if known_episode is not None:
+        return fix_filename(known_episode['show_name']), known_episode['duration_ms'], fix_filename(known_episode['name'])
+
+    with metrics.phase("metadata"):
+        (raw, info) = invoke_url(spotifySession,f'{EPISODE_INFO_URL}/{episode_id_str}')
 
     if not info:
         raise ValueError(f'Invalid response from EPISODE_INFO_URL:\n{raw}')
     try:
         duration_ms = info['duration_ms']
+        state.save_episode(episode_id_str, info['show']['name'], info['name'], duration_ms)
         return fix_filename(info['show']['name']), duration_ms, fix_filename(info['name'])
     except Exception as e:
         raise ValueError(f'Failed to parse EPISODE_INFO_URL response: {str(e)}\n{raw}')
 
-def get_song_info(spotifySession,song_id) -> tuple[list[str], list[any], str, str, any, any, any, any, any, any, int]:
-    """ Retrieves metadata for downloaded songs """
-
-    (raw, info) = invoke_url(spotifySession,f'{TRACKS_URL}?ids={song_id}&market=from_token')
-    if not 'tracks' in info:
-        raise ValueError(f'Invalid response from TRACKS_URL:\n{raw}')
-
-    try:
-        artists = []
-        for data in info['tracks'][0]['artists']:
-            artists.append(data['name'])
-
-        album_name = info['tracks'][0]['album']['name']
-        name = info['tracks'][0]['name']
-        release_year = info['tracks'][0]['album']['release_date'].split('-')[0]
-        disc_number = info['tracks'][0]['disc_number']
-        track_number = info['tracks'][0]['track_number']
-        scraped_song_id = info['tracks'][0]['id']
-        is_playable = info['tracks'][0]['is_playable']
-        duration_ms = info['tracks'][0]['duration_ms']
-
-        image = info['tracks'][0]['album']['images'][0]
-        for i in info['tracks'][0]['album']['images']:
-            if i['width'] > image['width']:
-                image = i
+@dataclass
+class TrackInfo:
+    """ Metadata of a single spotify track """
+    id: str
+    name: str
+    artists: list[str]
+    album_name: str
+    image_url: Optional[str]
+    release_year: str
+    disc_number: int
+    track_number: int
+    is_playable: bool
+    duration_ms: int
+
+def parse_track_info(track) -> TrackInfo:
+    """ Builds a TrackInfo from a spotify track object (TRACKS_URL or embedded in a playlist page) """
+    image_url = None
+    images = track['album'].get('images') or []
+    if len(images) > 0:
+        image = max(images, key=lambda i: i.get('width') or 0)
         image_url = image['url']
 
-        return artists, info['tracks'][0]['artists'], album_name, name, image_url, release_year, disc_number, track_number, scraped_song_id, is_playable, duration_ms
-    except Exception as e:
-        raise ValueError(f'Failed to parse TRACKS_URL response: {str(e)}\n{raw}')
+    return TrackInfo(
+        id=track['id'],
+        name=track['name'],
+        artists=[data['name'] for data in track['artists']],
+        album_name=track['album']['name'],
+        image_url=image_url,
+        release_year=track['album']['release_date'].split('-')[0],
+        disc_number=track['disc_number'],
+        track_number=track['track_number'],
+        is_playable=track['is_playable'],
+        duration_ms=track['duration_ms'],
+    )
+
+def get_tracks_info(spotifySession, track_ids) -> dict[str, TrackInfo]:
+    """ Retrieves metadata for the given songs, TRACKS_BATCH_SIZE ids per request """
+    tracks_info = {}
+    track_ids = list(dict.fromkeys(track_ids))
+
+    for offset in range(0, len(track_ids), TRACKS_BATCH_SIZE):
+        batch = track_ids[offset:offset + TRACKS_BATCH_SIZE]
+        (raw, info) = invoke_url(spotifySession,f'{TRACKS_URL}?ids={",".join(batch)}&market=from_token')
+        if not 'tracks' in info:
+            raise ValueError(f'Invalid response from TRACKS_URL:\n{raw}')
+
+        for track_id, track in zip(batch, info['tracks']):
+            if track is None:
+                logging.warning(f"No metadata found for track with Id {track_id}")
+                continue
+            try:
+                tracks_info[track_id] = parse_track_info(track)
+            except Exception as e:
+                raise ValueError(f'Failed to parse TRACKS_URL response: {str(e)}\n{raw}')
+
+    return tracks_info
+
+@dataclass
+class PlaylistEntry:
+    id: str
+    type: str
+    name: str
+    info: Optional[TrackInfo]
+
+def parse_playlist_page(spotifySession, page) -> list[PlaylistEntry]:
+    """ Builds the entries of a playlist page, tracks with incomplete embedded metadata are looked up via TRACKS_URL """
+    entries = []
+    missing_ids = []
+
+    for item in page['items']:
+        track = item.get('track')
+        if track is None or track.get('id') is None:
+            continue
+        info = None
+        if track.get('type') == "track":
+            try:
+                info = parse_track_info(track)
+            except (KeyError, TypeError, AttributeError):
+                missing_ids.append(track['id'])
+        entries.append(PlaylistEntry(track['id'], track.get('type'), track.get('name'), info))
+
+    if len(missing_ids) > 0:
+        logging.info(f"Fetching metadata for {len(missing_ids)} tracks...")
+        with metrics.phase("metadata"):
+            tracks_info = get_tracks_info(spotifySession, missing_ids)
+        for entry in entries:
+            if entry.info is None:
+                entry.info = tracks_info.get(entry.id)
+
+    return entries
+
+def get_show_episodes(spotifySession, state, show_id_str, latest=None) -> list:
+    """ returns the episode ids of a show (newest first), only pages until the newest already known episode """
+    known_show = state.get_show(show_id_str)
+    known_episodes = []
+    if known_show is not None and (known_show['window'] is None or (latest is not None and latest <= known_show['window'])):
+        known_episodes = json.loads(known_show['episodes'])
+    known_set = set(known_episodes)
+
+    if known_show is not None:
+        show_name = known_show['name']
+    else:
+        (raw, info) = invoke_url(spotifySession,f'{SHOWS_URL}/{show_id_str}?market=from_token')
+        if not 'name' in info:
+            raise ValueError(f'Invalid response from SHOWS_URL:\n{raw}')
+        show_name = info['name']
 
-def get_show_episodes(spotifySession, show_id_str) -> list:
     episodes = []
     offset = 0
     limit = 50
 
-    while True:
-        resp = invoke_url_with_params(spotifySession,f'{SHOWS_URL}/{show_id_str}/episodes', limit=limit, offset=offset)
-        offset += limit
+    while latest is None or offset < latest:
+        page_limit = limit if latest is None else min(limit, latest - offset)
+        resp = invoke_url_with_params(spotifySession,f'{SHOWS_URL}/{show_id_str}/episodes', limit=page_limit, offset=offset)
+        offset += page_limit
+        reached_known = False
+        page_episodes = []
         for episode in resp['items']:
+            if episode is None:
+                continue
+            if episode['id'] in known_set:
+                reached_known = True
+                break
             episodes.append(episode['id'])
-        if len(resp['items']) < limit:
+            page_episodes.append((episode['id'], episode['name'], episode['duration_ms']))
+        state.save_episodes(show_name, page_episodes)
+        if reached_known or len(resp['items']) < page_limit:
             break
 
+    logging.info(f"Found {len(episodes)} new episodes of '{show_name}'")
+    episodes = list(dict.fromkeys(episodes + known_episodes))
+    if latest is not None:
+        episodes = episodes[:latest]
+    if not args.dry_run:
+        # (episode metadata is only a cache of the spotify api and kept on dry runs as well)
+        state.save_show(show_id_str, show_name, episodes, latest)
     return episodes
 
-def get_playlist_songs(spotifySession,playlist_id):
-    """ returns list of songs in a playlist """
-    songs = []
-    offset = 0
-    limit = 100
-
-    while True:
-        resp = invoke_url_with_params(spotifySession,f'{PLAYLISTS_URL}/{playlist_id}/tracks', limit=limit, offset=offset)
-        offset += limit
-        songs.extend(resp['items'])
-        if len(resp['items']) < limit:
-            break
-
-    return songs
-
-def invoke_url(spotifySession, url, tryCount=0):
-        headers = get_auth_header(spotifySession)
-        response = requests.get(url, headers=headers)
+def get_playlist_snapshot_id(spotifySession, playlist_id) -> Optional[str]:
+    """ returns the current snapshot_id of a playlist """
+    (raw, info) = invoke_url(spotifySession,f'{PLAYLISTS_URL}/{playlist_id}?fields=snapshot_id')
+    return info.get('snapshot_id')
+
+def get_playlist_page(spotifySession, playlist_id, offset) -> dict:
+    with metrics.phase("playlist"):
+        return invoke_url_with_params(spotifySession,f'{PLAYLISTS_URL}/{playlist_id}/tracks', limit=PLAYLIST_PAGE_SIZE, offset=offset, market='from_token', fields=PLAYLIST_ITEM_FIELDS)
+
+def iter_playlist_entries(spotifySession, playlist_id) -> Iterator[PlaylistEntry]:
+    """ Yields the entries of a playlist page by page, up to PLAYLIST_PAGE_WORKERS following pages are fetched meanwhile """
+    first_page = get_playlist_page(spotifySession, playlist_id, 0)
+    offsets = iter(range(PLAYLIST_PAGE_SIZE, first_page.get('total', 0), PLAYLIST_PAGE_SIZE))
+    with ThreadPoolExecutor(max_workers=PLAYLIST_PAGE_WORKERS, thread_name_prefix="playlist") as pool:
+        pending = deque(pool.submit(get_playlist_page, spotifySession, playlist_id, offset) for offset in itertools.islice(offsets, PLAYLIST_PAGE_WORKERS))
+        yield from parse_playlist_page(spotifySession, first_page)
+        while len(pending) > 0:
+            page = pending.popleft().result()
+            offset = next(offsets, None)
+            if offset is not None:
+                pending.append(pool.submit(get_playlist_page, spotifySession, playlist_id, offset))
+            yield from parse_playlist_page(spotifySession, page)
+
+class TokenBucket:
+    """ Thread safe token bucket, refilled with rate tokens per second up to capacity """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1) -> None:
+        """ Blocks until tokens are available """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = max(self.paused_until - now, (tokens - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds) -> None:
+        """ Hands out no tokens for the next seconds (e.g. because of a Retry-After header) """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+@dataclass
+class EndpointStats:
+    requests: int = 0
+    errors: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+
+class SpotifyApiClient:
+    """ Pooled HTTP session with retries (exponential backoff + jitter), rate limiting and per endpoint stats """
+
+    def __init__(self, rate, tries=3):
+        self.http = requests.Session()
+        self.http.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16))
+        self.bucket = TokenBucket(rate, max(1, int(rate * 2)))
+        self.tries = tries
+        self.stats = defaultdict(EndpointStats)
+        self.stats_lock = threading.Lock()
+
+    def get(self, spotifySession, url, params=None) -> requests.Response:
+        """ GET on the spotify api, rate limited and authenticated """
+        return self.request(url, spotifySession=spotifySession, params=params)
+
+    def fetch(self, url, **kwargs) -> requests.Response:
+        """ Plain GET (cdn / images) over the pooled session """
+        return self.request(url, **kwargs)
+
+    def request(self, url, spotifySession=None, **kwargs) -> requests.Response:
+        endpoint = get_endpoint_name(url)
+        for attempt in range(self.tries):
+            last_try = attempt == self.tries - 1
+            delay = 2 ** attempt + random.uniform(0, 1)
+            if spotifySession is not None:
+                self.bucket.acquire()
+                kwargs['headers'] = get_auth_header(spotifySession)
+
+            time_start = time.monotonic()
+            try:
+                response = self.http.get(url, timeout=30, **kwargs)
+            except requests.RequestException as ex:
+                self.record(endpoint, time.monotonic() - time_start, True)
+                if last_try:
+                    raise
+                logging.warning(f"Request to {endpoint} failed (try {attempt + 1}): {ex} => retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            retryable = response.status_code == 429 or response.status_code >= 500
+            self.record(endpoint, time.monotonic() - time_start, retryable or response.status_code >= 400)
+
+            if response.status_code == 401 and spotifySession is not None and not last_try:
+                logging.warning("Spotify access token rejected => requesting a new one")
+                spotifySession.invalidate_token(kwargs['headers']['Authorization'].removeprefix('Bearer '))
+                continue
+            if not retryable or last_try:
+                return response
+
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            if response.status_code == 429:
+                self.bucket.pause(delay)
+            logging.warning(f"Request to {endpoint} returned {response.status_code} (try {attempt + 1}) => retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    def record(self, endpoint, seconds, error) -> None:
+        with self.stats_lock:
+            stats = self.stats[endpoint]
+            stats.requests += 1
+            stats.errors += 1 if error else 0
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def get_stats(self, reset=False) -> dict[str, EndpointStats]:
+        with self.stats_lock:
+            stats = dict(self.stats)
+            if reset:
+                self.stats = defaultdict(EndpointStats)
+        return stats
+
+    def log_stats(self) -> None:
+        with self.stats_lock:
+            for endpoint, stats in sorted(self.stats.items()):
+                logging.info(f"{endpoint}: {stats.requests} requests, {stats.errors} errors, "
+                             f"avg {stats.total_seconds / stats.requests * 1000:.0f}ms, max {stats.max_seconds * 1000:.0f}ms")
+
+def get_endpoint_name(url) -> str:
+    """ host + path of an url with ids replaced, e.g. api.spotify.com/v1/playlists/{id}/tracks """
+    parsed = urlparse(url)
+    return parsed.netloc + re.sub(r'/[0-9a-zA-Z]{16,}(?=/|$)', '/{id}', parsed.path)
+
+# replaced with the configured rate by SpoonieSync
+spotify_api = SpotifyApiClient(10.0)
+
+@dataclass
+class PhaseStats:
+    count: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    bytes: int = 0
+
+class RunMetrics:
+    """ Timers and byte counters per sync phase, seconds are summed over all worker threads """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = defaultdict(PhaseStats)
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        time_start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - time_start)
+
+    def record(self, name, seconds, size=0) -> None:
+        with self.lock:
+            stats = self.phases[name]
+            stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.bytes += size
+
+    def add_bytes(self, name, size) -> None:
+        with self.lock:
+            self.phases[name].bytes += size
+
+    def finish(self, syncs, failed_syncs) -> dict:
+        """ Returns the summary of the run and starts a new one """
+        with self.lock:
+            phases, started = self.phases, self.started
+            self.phases = defaultdict(PhaseStats)
+            self.started = time.time()
+        return {
+            "started": started,
+            "seconds": time.time() - started,
+            "syncs": syncs,
+            "failed_syncs": failed_syncs,
+            "phases": {name: vars(stats) for name, stats in sorted(phases.items())},
+            "spotify_requests": {endpoint: vars(stats) for endpoint, stats in sorted(spotify_api.get_stats(reset=True).items())},
+        }
+
+metrics = RunMetrics()
+
+def format_prometheus_metrics(summary) -> str:
+    """ Prometheus text exposition format of a run summary """
+    lines = [
+        "# TYPE spoonie_last_run_timestamp_seconds gauge",
+        f"spoonie_last_run_timestamp_seconds {summary['started']:.0f}",
+        "# TYPE spoonie_last_run_duration_seconds gauge",
+        f"spoonie_last_run_duration_seconds {summary['seconds']:.3f}",
+        "# TYPE spoonie_last_run_failed_syncs gauge",
+        f"spoonie_last_run_failed_syncs {summary['failed_syncs']}",
+    ]
+    for metric, key in (("phase_seconds", "seconds"), ("phase_count", "count"), ("phase_bytes", "bytes")):
+        lines.append(f"# TYPE spoonie_last_run_{metric} gauge")
+        lines += [f'spoonie_last_run_{metric}{{phase="{name}"}} {stats[key]}' for name, stats in summary["phases"].items()]
+    for metric, key in (("spotify_requests", "requests"), ("spotify_request_errors", "errors"), ("spotify_request_seconds", "total_seconds")):
+        lines.append(f"# TYPE spoonie_last_run_{metric} gauge")
+        lines += [f'spoonie_last_run_{metric}{{endpoint="{endpoint}"}} {stats[key]}' for endpoint, stats in summary["spotify_requests"].items()]
+    return "\n".join(lines) + "\n"
+
+def write_atomically(path, content) -> None:
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(path)), suffix=".part", delete=False) as part_file:
+        part_file.write(content)
+    os.replace(part_file.name, path)
+
+def finish_run_metrics(syncs, failed_syncs) -> dict:
+    """ Logs the phase timings of the run and writes the run summary (and prometheus metrics) """
+    spotify_api.log_stats()
+    summary = metrics.finish(syncs, failed_syncs)
+    for name, stats in summary["phases"].items():
+        logging.info(f"Phase {name}: {stats['count']}x, {stats['seconds']:.1f}s (max {stats['max_seconds']:.1f}s), {stats['bytes'] / 1024 / 1024:.1f} MB")
+    write_atomically(os.path.join(args.data_path, RUN_SUMMARY_FILENAME), json.dumps(summary, indent=2))
+    if args.prometheus_file is not None:
+        write_atomically(args.prometheus_file, format_prometheus_metrics(summary))
+    return summary
+
+def invoke_url(spotifySession, url):
+        response = spotify_api.get(spotifySession, url)
         responsetext = response.text
         try:
             responsejson = response.json()
@@ -236,24 +640,72 @@ def invoke_url(spotifySession, url, tryCount=0):
             responsejson = {"error": {"status": "unknown", "message": "received an empty response"}}
 
         if not responsejson or 'error' in responsejson:
-            if tryCount < (3 - 1):
-                logging.warning(f"Spotify API Error (try {tryCount + 1}) ({responsejson['error']['status']}): {responsejson['error']['message']}")
-                time.sleep(5)
-                return invoke_url(spotifySession,url, tryCount + 1)
-
             logging.error(f"Spotify API Error ({responsejson['error']['status']}): {responsejson['error']['message']}")
 
         return responsetext, responsejson
 
 def invoke_url_with_params(spotifySession,url, limit, offset, **kwargs):
-        headers, params = get_auth_header_and_params(spotifySession,limit=limit, offset=offset)
+        params = {'limit': limit, 'offset': offset}
         params.update(kwargs)
-        return requests.get(url, headers=headers, params=params).json()
+        return spotify_api.get(spotifySession, url, params=params).json()
+
+class SpotifySession:
+    """ librespot session which logs in on first use, the access token is cached in memory and in the data path """
+
+    def __init__(self, credentials_file, token_file):
+        self.credentials_file = credentials_file
+        self.token_file = token_file
+        self.session = None
+        self.access_token = None
+        self.expires_at = 0.0
+        self.lock = threading.RLock()
+        self.load_token()
+
+    def librespot(self) -> "Session":
+        with self.lock:
+            if self.session is None:
+                from librespot.core import Session
+
+                logging.info("Logging in to spotify...")
+                conf = Session.Configuration.Builder().set_store_credentials(False).build()
+                self.session = Session.Builder(conf).stored_file(self.credentials_file).create()
+            return self.session
+
+    def get_access_token(self) -> str:
+        with self.lock:
+            if self.access_token is None or time.time() > self.expires_at - TOKEN_REFRESH_MARGIN:
+                token = self.librespot().tokens().get_token(*SPOTIFY_SCOPES)
+                # librespot hands out its cached token until shortly before it expires, expires_in is its full lifetime
+                expires_at = token.timestamp / 1e6 + token.expires_in
+                if token.access_token != self.access_token or expires_at != self.expires_at:
+                    self.access_token = token.access_token
+                    self.expires_at = expires_at
+                    self.save_token()
+            return self.access_token
+
+    def invalidate_token(self, access_token) -> None:
+        """ Drops the cached token (e.g. after a 401), unless it was already replaced """
+        with self.lock:
+            if self.access_token == access_token:
+                self.access_token = None
+
+    def load_token(self) -> None:
+        try:
+            with open(self.token_file) as f:
+                token = json.load(f)
+            self.access_token = token['access_token']
+            self.expires_at = token['expires_at']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save_token(self) -> None:
+        part_file = f"{self.token_file}.part"
+        with open(os.open(part_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump({'access_token': self.access_token, 'expires_at': self.expires_at}, f)
+        os.replace(part_file, self.token_file)
 
 def get_auth_token(spotifySession):
-        return spotifySession.tokens().get_token(
-            "user-read-email", "playlist-read-private", "user-library-read", "user-follow-read"
-        ).access_token
+        return spotifySession.get_access_token()
 
 def get_credentials_location():
     return os.path.join(args.data_path,"credentials.json")
@@ -266,14 +718,6 @@ def get_auth_header(spotifySession):
         'app-platform': 'WebPlayer'
     }
 
-def get_auth_header_and_params(spotifySession,limit, offset):
-        return {
-            'Authorization': f'Bearer {get_auth_token(spotifySession)}',
-            'Accept-Language': 'en',
-            'Accept': 'application/json',
-            'app-platform': 'WebPlayer'
-        }, {'limit': limit, 'offset': offset}
-
 def fmt_seconds(secs: float) -> str:
     val = math.floor(secs)
 
@@ -296,311 +740,1453 @@ def fmt_seconds(secs: float) -> str:
     else:
         return f'{h}'.zfill(2) + ':' + f'{m}'.zfill(2) + ':' + f'{s}'.zfill(2)
 
-def get_content_stream(spotifySession, content_id, quality):
-        return spotifySession.content_feeder().load(content_id, VorbisOnlyAudioQuality(quality), False, None)
+def get_content_stream(spotifySession, content_id):
+    from librespot.audio.decoders import AudioQuality, VorbisOnlyAudioQuality
+
+    return spotifySession.librespot().content_feeder().load(content_id, VorbisOnlyAudioQuality(AudioQuality.HIGH), False, None)
 
 def conv_artist_format(artists) -> str:
     """ Returns converted artist format """
     return ', '.join(artists)
 
-def set_audio_tags(filename, artists, name, album_name, release_year, disc_number, track_number) -> None:
-    """ sets music_tag metadata """
-    tags = music_tag.load_file(filename)
-    tags['albumartist'] = artists[0]
-    tags['artist'] = conv_artist_format(artists)
-    tags['tracktitle'] = name
-    tags['album'] = album_name
-    tags['year'] = release_year
-    tags['discnumber'] = disc_number
-    tags['tracknumber'] = track_number
-    tags.save()
-
-def set_music_thumbnail(filename, image_url) -> None:
-    """ Downloads cover artwork """
-    img = requests.get(image_url).content
-    tags = music_tag.load_file(filename)
-    tags['artwork'] = img
-    tags.save()
-
-def convert_audio_format(temp_filename,filename) -> None:
-    """ Converts raw audio into playable file """
-    file_codec = 'libmp3lame'
-    if file_codec != 'copy':
-        bitrate = '160k'
-    else:
-        bitrate = None
+def get_track_tags(info) -> dict:
+    """ ID3 tags of a track, as ffmpeg metadata keys """
+    return {
+        'album_artist': info.artists[0],
+        'artist': conv_artist_format(info.artists),
+        'title': info.name,
+        'album': info.album_name,
+        'date': info.release_year,
+        'disc': info.disc_number,
+        'track': info.track_number,
+    }
 
-    output_params = ['-c:a', file_codec]
-    if bitrate:
-        output_params += ['-b:a', bitrate]
+class ArtworkCache:
+    """ Cover artwork cache keyed by image url, evicts the least recently used files above max_bytes """
+
+    def __init__(self, path, max_bytes, max_size=0, quality=80):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+        self.quality = quality
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        os.makedirs(self.path, exist_ok=True)
+
+    def get(self, image_url) -> Optional[str]:
+        """ Returns the path of the (downscaled) cover, downloads it if not cached yet """
+        if image_url is None:
+            return None
+
+        key = hashlib.sha256(f"{image_url}|{self.max_size}|{self.quality}".encode()).hexdigest()
+        artwork_file = os.path.join(self.path, f"{key}.jpg")
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            if os.path.isfile(artwork_file):
+                os.utime(artwork_file)
+                return artwork_file
+
+            with metrics.phase("artwork"):
+                try:
+                    response = spotify_api.fetch(image_url)
+                    response.raise_for_status()
+                except requests.RequestException as ex:
+                    logging.warning(f"Failed to download cover artwork {image_url}: {ex}")
+                    return None
+
+                img = response.content
+                metrics.add_bytes("artwork", len(img))
+                if self.max_size > 0:
+                    try:
+                        img = resize_artwork(img, self.max_size, self.quality)
+                    except (OSError, ValueError) as ex:
+                        # PIL.UnidentifiedImageError and truncated images are OSErrors
+                        logging.warning(f"Failed to decode cover artwork {image_url}: {ex} => no cover")
+                        return None
+
+            with tempfile.NamedTemporaryFile(dir=self.path, suffix=".part", delete=False) as part_file:
+                part_file.write(img)
+            os.replace(part_file.name, artwork_file)
+            return artwork_file
+
+    def evict(self) -> None:
+        """ Removes least recently used covers until the cache fits into max_bytes """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            logging.debug(f"Evicting cover artwork {path}")
+            os.unlink(path)
+            total_size -= size
+
+def resize_artwork(img, max_size, quality) -> bytes:
+    """ Downscales cover artwork to max_size x max_size and recompresses it as JPEG """
+    import io
+    from PIL import Image
+
+    with Image.open(io.BytesIO(img)) as image:
+        image.thumbnail((max_size, max_size))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+@dataclass
+class EncodeProfile:
+    codec: str
+    bitrate: Optional[str]
+    channels: Optional[int]
+    sample_rate: Optional[int]
+    format: str
+    extension: str
+
+    @property
+    def has_cover(self) -> bool:
+        return self.format == 'mp3'
+
+ENCODE_PROFILES = {
+    "mp3": EncodeProfile('libmp3lame', '160k', None, None, 'mp3', 'mp3'),
+    "mp3-mono": EncodeProfile('libmp3lame', '96k', 1, 44100, 'mp3', 'mp3'),
+    "passthrough": EncodeProfile('copy', None, None, None, 'ogg', 'ogg'),
+}
+
+# formats the tonie cloud accepts for uploads (by file signature), direct podcast downloads in these are not transcoded
+TONIE_AUDIO_SIGNATURES = {
+    # mpeg frame sync with a layer != 0 (AAC ADTS headers FF F1 / FF F9 have layer 0)
+    'mp3': lambda header: header.startswith(b'ID3') or (len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0 and header[1] & 0x06 != 0),
+    'ogg': lambda header: header.startswith(b'OggS'),
+    'm4a': lambda header: header[4:8] == b'ftyp',
+    'wav': lambda header: header.startswith(b'RIFF') and header[8:12] == b'WAVE',
+    'flac': lambda header: header.startswith(b'fLaC'),
+}
+
+def get_encode_profile() -> EncodeProfile:
+    """ The selected encode profile including the overrides of the command line """
+    profile = ENCODE_PROFILES[args.encode_profile]
+    if profile.codec == 'copy':
+        return profile
+    return replace(profile,
+                   bitrate=args.encode_bitrate or profile.bitrate,
+                   channels=args.encode_channels or profile.channels,
+                   sample_rate=args.encode_sample_rate or profile.sample_rate)
+
+def get_audio_format(filename) -> Optional[str]:
+    """ Detects a tonie compatible audio format by the file signature, None if unknown """
+    with open(filename, "rb") as f:
+        header = f.read(12)
+    return next((audio_format for audio_format, matches in TONIE_AUDIO_SIGNATURES.items() if matches(header)), None)
+
+def get_audio_tag_params(tags, artwork_file) -> list[str]:
+    """ ffmpeg output options which write the tags and the cover (second input, mp3 only) while encoding """
+    params = ['-map', '0:a']
+    if artwork_file is not None:
+        params += ['-map', '1:v', '-c:v', 'copy', '-disposition:v', 'attached_pic',
+                   '-metadata:s:v', 'title=Album cover', '-metadata:s:v', 'comment=Cover (front)']
+    if get_encode_profile().format == 'mp3':
+        params += ['-id3v2_version', '3']
+    for key, value in (tags or {}).items():
+        params += ['-metadata', f'{key}={value}']
+    return params
+
+def get_audio_output_params() -> list[str]:
+    """ ffmpeg output options of the final audio files """
+    profile = get_encode_profile()
+
+    output_params = ['-c:a', profile.codec]
+    if profile.bitrate:
+        output_params += ['-b:a', profile.bitrate]
+    if profile.channels:
+        output_params += ['-ac', str(profile.channels)]
+    if profile.sample_rate:
+        output_params += ['-ar', str(profile.sample_rate)]
+    if args.ffmpeg_threads is not None:
+        output_params += ['-threads', str(args.ffmpeg_threads)]
+    return output_params + ['-f', profile.format]
+
+def convert_audio_format(temp_filename,filename,tags=None,artwork_file=None) -> None:
+    """ Converts raw audio into playable file, tags and cover are written in the same pass """
+    import ffmpy
+
+    output_params = get_audio_output_params()
+
+    inputs = {temp_filename: None}
+    if artwork_file is not None:
+        inputs[artwork_file] = None
 
     try:
         ff_m = ffmpy.FFmpeg(
             global_options=['-y', '-hide_banner', '-loglevel error'],
-            inputs={temp_filename: None},
-            outputs={filename: output_params}
+            inputs=inputs,
+            outputs={filename: output_params + get_audio_tag_params(tags, artwork_file)}
         )
         logging.debug("Converting file...")
-        ff_m.run()
+        with metrics.phase("encode"):
+            ff_m.run(stderr=subprocess.PIPE)
 
     except ffmpy.FFExecutableNotFoundError:
-        logging.warning(f"Skipping {file_codec.upper()} conversion - ffmpeg not found!")
+        raise RuntimeError(f"{output_params[1].upper()} conversion not possible - ffmpeg not found!")
+
+def stream_spotify_track(spotifySession, name, track, track_duration_ms, file_fullpath, tags=None, artwork_file=None, governor=None) -> None:
+    """ Pipes the decrypted stream into ffmpeg while it is still downloading """
+    command = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0']
+    if artwork_file is not None:
+        command += ['-i', artwork_file]
+    command += get_audio_output_params() + get_audio_tag_params(tags, artwork_file) + [file_fullpath]
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    except FileNotFoundError:
+        raise RuntimeError("Streaming conversion not possible - ffmpeg not found!")
+
+    try:
+        downloadSpotifyTrack(spotifySession, name, track, track_duration_ms, process.stdin, file_fullpath, governor=governor)
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {process.returncode}")
+    except BaseException:
+        process.kill()
+        process.wait()
+        if os.path.exists(file_fullpath):
+            os.unlink(file_fullpath)
+        raise
 
 def download_podcast_directly(url, filename):
-    import functools
-    import shutil
-    import requests
+    """ Downloads a podcast from its cdn into a .part file (resumable, in parallel byte ranges) and renames it when complete """
     from tqdm.auto import tqdm
 
-    r = requests.get(url, stream=True, allow_redirects=True)
-    if r.status_code != 200:
+    time_start = time.monotonic()
+    path = Path(filename).expanduser().resolve()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = path.with_name(path.name + ".part")
+    progress_path = path.with_name(path.name + ".part.json")
+
+    r = spotify_api.fetch(url, headers={'Range': 'bytes=0-0'}, stream=True, allow_redirects=True)
+    r.close()
+    if r.status_code not in (200, 206):
         r.raise_for_status()  # Will only raise for 4xx codes, so...
         raise RuntimeError(
             f"Request to {url} returned status code {r.status_code}")
-    file_size = int(r.headers.get('Content-Length', 0))
 
-    path = Path(filename).expanduser().resolve()
-    path.parent.mkdir(parents=True, exist_ok=True)
+    if r.status_code != 206 or '/' not in r.headers.get('Content-Range', ''):
+        logging.info("Podcast cdn does not support range requests => downloading in one piece")
+        download_podcast_unranged(url, part_path)
+    else:
+        file_size = int(r.headers['Content-Range'].split('/')[1])
+        chunks = math.ceil(file_size / PODCAST_CHUNK_SIZE)
+
+        done = set()
+        try:
+            with open(progress_path) as f:
+                progress = json.load(f)
+            if progress['size'] == file_size and part_path.is_file():
+                done = set(progress['done'])
+        except (OSError, ValueError, KeyError):
+            pass
+        if len(done) > 0:
+            logging.info(f"Resuming podcast download ({len(done)}/{chunks} parts already present)")
+        else:
+            with part_path.open("wb") as f:
+                f.truncate(file_size)
+
+        progress_lock = threading.Lock()
+        workers = args.podcast_workers if file_size >= PODCAST_PARALLEL_THRESHOLD else 1
+        with tqdm(total=file_size, initial=sum(min(PODCAST_CHUNK_SIZE, file_size - i * PODCAST_CHUNK_SIZE) for i in done), unit='B', unit_scale=True) as progress_bar:
+            fd = os.open(part_path, os.O_WRONLY)
+            try:
+                def fetch_chunk(index):
+                    start = index * PODCAST_CHUNK_SIZE
+                    end = min(start + PODCAST_CHUNK_SIZE, file_size) - 1
+                    with_retries(lambda: download_podcast_range(url, fd, start, end, progress_bar), 3, f"Podcast download of bytes {start}-{end}")
+                    # the chunk must be on disk before the journal says so, otherwise a power loss leaves zero filled holes
+                    getattr(os, "fdatasync", os.fsync)(fd)
+                    with progress_lock:
+                        done.add(index)
+                        with open(f"{progress_path}.tmp", "w") as f:
+                            json.dump({'size': file_size, 'done': sorted(done)}, f)
+                        os.replace(f"{progress_path}.tmp", progress_path)
+
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="podcast") as pool:
+                    for future in [pool.submit(fetch_chunk, i) for i in range(chunks) if i not in done]:
+                        future.result()
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        if len(done) != chunks or os.path.getsize(part_path) != file_size:
+            raise RuntimeError(f"Podcast download incomplete: {os.path.getsize(part_path)} of {file_size} bytes")
+
+    metrics.record("download", time.monotonic() - time_start, os.path.getsize(part_path))
+    os.replace(part_path, path)
+    if progress_path.exists():
+        progress_path.unlink()
+    return path
+
+def download_podcast_range(url, fd, start, end, progress_bar) -> None:
+    """ Writes the bytes start-end (inclusive) of url at the same offsets into fd """
+    r = spotify_api.fetch(url, headers={'Range': f'bytes={start}-{end}'}, stream=True, allow_redirects=True)
+    with r:
+        if r.status_code != 206:
+            raise RuntimeError(f"Range request returned status code {r.status_code}")
+        offset = start
+        for block in r.iter_content(1024 * 1024):
+            os.pwrite(fd, block, offset)
+            offset += len(block)
+            progress_bar.update(len(block))
+    if offset != end + 1:
+        raise RuntimeError(f"Range request returned {offset - start} of {end + 1 - start} bytes")
+
+def download_podcast_unranged(url, part_path) -> None:
+    """ Streams url into part_path in one request, checked against its Content-Length """
+    import shutil
+    from tqdm.auto import tqdm
+
+    r = spotify_api.fetch(url, stream=True, allow_redirects=True)
+    r.raise_for_status()
+    file_size = int(r.headers.get('Content-Length', 0))
 
     desc = "(Unknown total file size)" if file_size == 0 else ""
     r.raw.read = functools.partial(
         r.raw.read, decode_content=True)  # Decompress if needed
     with tqdm.wrapattr(r.raw, "read", total=file_size, desc=desc) as r_raw:
-        with path.open("wb") as f:
+        with part_path.open("wb") as f:
             shutil.copyfileobj(r_raw, f)
-
-    return path
-
-def downloadSpotifyTrack(spotifySession, name, track, track_duration_ms, download_tempfile, file_fullpath):
-    stream = get_content_stream(spotifySession,track, AudioQuality.HIGH)
-    total_size = stream.input_stream.size
-    time_start = time.time()
-    downloaded = 0
-    b = 0
-    while b < 5:
-        data = stream.input_stream.stream().read(20000)
-        download_tempfile.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    if file_size != 0 and os.path.getsize(part_path) != file_size and 'Content-Encoding' not in r.headers:
+        raise RuntimeError(f"Podcast download incomplete: {os.path.getsize(part_path)} of {file_size} bytes")
+
+class DownloadQuotaExceeded(RuntimeError):
+    pass
+
+class RateGovernor:
+    """ Ban protection for the whole run: one byte rate for all downloads, track quotas persisted in the sync state """
+
+    def __init__(self, state, bytes_per_second, tracks_per_hour, tracks_per_day):
+        self.state = state
+        self.bytes = TokenBucket(bytes_per_second, bytes_per_second * 10)
+        self.tracks_per_hour = tracks_per_hour
+        self.tracks_per_day = tracks_per_day
+        self.lock = threading.Lock()
+
+    def start_track(self) -> None:
+        """ Books a track download, raises DownloadQuotaExceeded if the hourly or daily quota is used up """
+        with self.lock:
+            now = time.time()
+            if self.state.count_downloads_since(now - 3600) >= self.tracks_per_hour:
+                raise DownloadQuotaExceeded(f"Ban protection: {self.tracks_per_hour} tracks per hour reached")
+            if self.state.count_downloads_since(now - 86400) >= self.tracks_per_day:
+                raise DownloadQuotaExceeded(f"Ban protection: {self.tracks_per_day} tracks per day reached")
+            self.state.add_download(now)
+
+    def consume(self, size) -> None:
+        """ Blocks until size bytes may be downloaded """
+        self.bytes.acquire(min(size, self.bytes.capacity))
+
+def downloadSpotifyTrack(spotifySession, name, track, track_duration_ms, output, file_fullpath, stream=None, offset=0, governor=None):
+    """ Copies the audio stream from offset to output, reads grow while the stream keeps up and are collected into 1MB writes """
+    if stream is None:
+        if governor is not None:
+            governor.start_track()
+        stream = get_content_stream(spotifySession,track)
+    input_stream = stream.input_stream.stream()
+    # librespot skipped the 0xA7 byte header before handing out the stream => the audio starts at its current position
+    payload_start = input_stream.pos()
+    payload_size = stream.input_stream.size - payload_start
+    if offset > 0:
+        # offsets count audio bytes, seek() takes absolute positions
+        input_stream.seek(payload_start + offset)
+
+    buffer = bytearray(STREAM_WRITE_BUFFER_SIZE)
+    view = memoryview(buffer)
+    filled = 0
+    read_size = STREAM_MIN_READ_SIZE
+    downloaded = offset
+    empty_reads = 0
+    time_reading = 0.0
+    time_start = time.monotonic()
+    while downloaded < payload_size:
+        wanted = min(read_size, payload_size - downloaded, STREAM_WRITE_BUFFER_SIZE - filled)
+        time_read = time.monotonic()
+        # librespot's chunked stream derives from BytesIO, its readinto() bypasses the chunk logic
+        data = input_stream.read(wanted)
+        time_reading += time.monotonic() - time_read
+        if not data:
+            empty_reads += 1
+            if empty_reads >= 5:
+                raise IOError(f"Stream of '{name}' ended after {downloaded} of {payload_size} bytes")
+            continue
+        empty_reads = 0
+        view[filled:filled + len(data)] = data
+        filled += len(data)
         downloaded += len(data)
-        b += 1 if data == b'' else 0
-        if args.ban_protection:
-            delta_real = time.time() - time_start
-            delta_want = (downloaded / total_size) * (track_duration_ms/5000)
-            if delta_want > delta_real:
-                time.sleep(delta_want - delta_real)
-    time_downloaded = time.time()
-    logging.info(f"Downloaded '{name}' in {fmt_seconds(time_downloaded - time_start)} seconds!")
+        if len(data) == wanted:
+            read_size = min(read_size * 2, STREAM_MAX_READ_SIZE)
+        else:
+            read_size = max(read_size // 2, STREAM_MIN_READ_SIZE)
+        if filled == STREAM_WRITE_BUFFER_SIZE:
+            output.write(view)
+            filled = 0
+        if governor is not None:
+            governor.consume(len(data))
+    if filled > 0:
+        output.write(view[:filled])
+
+    elapsed = time.monotonic() - time_start
+    received = downloaded - offset
+    metrics.record("download", elapsed, received)
+    throughput = received / elapsed / 1024 / 1024 if elapsed > 0 else 0.0
+    logging.info(f"Downloaded '{name}' in {fmt_seconds(elapsed)} seconds! ({received / 1024 / 1024:.1f} MB at {throughput:.2f} MB/s, {fmt_seconds(time_reading)} waiting for the stream)")
+
+def download_to_partial(spotifySession, name, track, track_duration_ms, spotify_id, governor=None) -> str:
+    """ Downloads a track into <data-path>/partial, continuing at the byte offset an earlier run got to """
+    partial_root = os.path.join(args.data_path, PARTIAL_FOLDER)
+    os.makedirs(partial_root, exist_ok=True)
+
+    # partial files are named <spotify id>.<audio size>.part => a complete one needs neither a stream nor quota
+    known_paths = glob.glob(os.path.join(partial_root, f"{spotify_id}.*.part"))
+    for known_path in known_paths:
+        try:
+            known_size = int(os.path.basename(known_path)[len(spotify_id) + 1:-len(".part")])
+        except ValueError:
+            continue
+        if os.path.getsize(known_path) >= known_size:
+            logging.info(f"'{name}' was already downloaded by an earlier run")
+            return known_path
+
+    if governor is not None and len(known_paths) == 0:
+        # resumed tracks were counted by the run which started them
+        governor.start_track()
+    stream = get_content_stream(spotifySession,track)
+    # the stream starts behind the header librespot skipped
+    payload_size = stream.input_stream.size - stream.input_stream.stream().pos()
+    partial_path = os.path.join(partial_root, f"{spotify_id}.{payload_size}.part")
+    for stale_path in known_paths:
+        if stale_path != partial_path:
+            os.unlink(stale_path)
+
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    if offset >= payload_size:
+        logging.info(f"'{name}' was already downloaded by an earlier run")
+        return partial_path
+    if offset > 0:
+        logging.info(f"Resuming download of '{name}' at byte {offset} of {payload_size}")
+
+    with open(partial_path, "ab") as partial_file:
+        downloadSpotifyTrack(spotifySession,name,track,track_duration_ms,partial_file,partial_path,stream,offset,governor)
+    return partial_path
+
+def finalize_output(part_fullpath, file_fullpath) -> None:
+    """ fsyncs a finished output file and atomically moves it to its final name """
+    with open(part_fullpath, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(part_fullpath, file_fullpath)
+    dir_fd = os.open(os.path.dirname(file_fullpath) or ".", os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class SyncState:
+    """ Persistent sync state (sqlite) which lets unchanged runs finish early """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                spotify_id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                duration_ms INTEGER NOT NULL,
+                content_hash TEXT,
+                chapter_id TEXT,
+                file_size INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS syncs (
+                sync_key TEXT PRIMARY KEY,
+                snapshot_id TEXT NOT NULL,
+                chapters TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS shows (
+                show_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                episodes TEXT NOT NULL,
+                window INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS episodes (
+                episode_id TEXT PRIMARY KEY,
+                show_name TEXT NOT NULL,
+                name TEXT NOT NULL,
+                duration_ms INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS downloads (
+                started_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sync_items (
+                sync_key TEXT NOT NULL,
+                spotify_id TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (sync_key, spotify_id)
+            );
+            CREATE TABLE IF NOT EXISTS uploads (
+                tonie_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                file_size INTEGER NOT NULL,
+                file_id TEXT NOT NULL,
+                PRIMARY KEY (tonie_id, title)
+            );
+        """)
+
+        columns = [row['name'] for row in self.connection.execute("PRAGMA table_info(tracks)")]
+        if 'file_size' not in columns:
+            self.connection.execute("ALTER TABLE tracks ADD COLUMN file_size INTEGER")
+        if 'last_used' not in columns:
+            self.connection.execute("ALTER TABLE tracks ADD COLUMN last_used REAL")
+
+    def get_track(self, spotify_id) -> Optional[sqlite3.Row]:
+        with self.lock:
+            return self.connection.execute("SELECT * FROM tracks WHERE spotify_id = ?", (spotify_id,)).fetchone()
+
+    def save_track(self, spotify_id, title, file_path, duration_ms, content_hash) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO tracks (spotify_id, title, file_path, duration_ms, content_hash, file_size, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (spotify_id) DO UPDATE SET title = excluded.title, file_path = excluded.file_path,
+                    duration_ms = excluded.duration_ms, content_hash = excluded.content_hash, file_size = excluded.file_size, last_used = excluded.last_used
+            """, (spotify_id, title, file_path, duration_ms, content_hash, os.path.getsize(file_path), time.time()))
+
+    def get_tracks(self) -> list[sqlite3.Row]:
+        with self.lock:
+            return self.connection.execute("SELECT * FROM tracks").fetchall()
+
+    def set_file_path(self, spotify_id, file_path, file_size) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE tracks SET file_path = ?, file_size = ? WHERE spotify_id = ?", (file_path, file_size, spotify_id))
+
+    def add_legacy_file(self, name, title, file_path, file_size) -> None:
+        """ Indexes a file of an older version (named by title) so it falls under the quota (never used => evicted first) """
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO tracks (spotify_id, title, file_path, duration_ms, file_size) VALUES (?, ?, ?, 0, ?)",
+                                    (f"{LEGACY_ID_PREFIX}{name}", title, file_path, file_size))
+
+    def get_legacy_file(self, title) -> Optional[sqlite3.Row]:
+        with self.lock:
+            return self.connection.execute("SELECT * FROM tracks WHERE spotify_id LIKE ? AND title = ?", (f"{LEGACY_ID_PREFIX}%", title)).fetchone()
+
+    def get_store_version(self) -> int:
+        with self.lock:
+            return self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+    def set_store_version(self, version) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(f"PRAGMA user_version = {int(version)}")
+
+    def get_store_size(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COALESCE(SUM(file_size), 0) FROM tracks").fetchone()[0]
+
+    def delete_track(self, spotify_id) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM tracks WHERE spotify_id = ?", (spotify_id,))
+
+    def save_sync_items(self, sync_key, spotify_ids) -> None:
+        """ Remembers everything a sync references (keeps the files in the download store) """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM sync_items WHERE sync_key = ?", (sync_key,))
+            self.connection.executemany("INSERT OR IGNORE INTO sync_items (sync_key, spotify_id, updated_at) VALUES (?, ?, ?)",
+                                        [(sync_key, spotify_id, now) for spotify_id in spotify_ids])
+            self.connection.execute("UPDATE tracks SET last_used = ? WHERE spotify_id IN (SELECT spotify_id FROM sync_items WHERE sync_key = ?)", (now, sync_key))
+
+    def touch_sync_items(self, sync_key) -> None:
+        """ Marks the items of an unchanged sync as still referenced """
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE sync_items SET updated_at = ? WHERE sync_key = ?", (now, sync_key))
+            self.connection.execute("UPDATE tracks SET last_used = ? WHERE spotify_id IN (SELECT spotify_id FROM sync_items WHERE sync_key = ?)", (now, sync_key))
+
+    def get_unreferenced_tracks(self, since) -> list[sqlite3.Row]:
+        """ Tracks no sync referenced since the given time, least recently used first """
+        with self.lock:
+            return self.connection.execute("""
+                SELECT * FROM tracks WHERE spotify_id NOT IN (SELECT spotify_id FROM sync_items WHERE updated_at >= ?)
+                ORDER BY COALESCE(last_used, 0)
+            """, (since,)).fetchall()
+
+    def set_chapter_id(self, spotify_id, chapter_id) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE tracks SET chapter_id = ? WHERE spotify_id = ?", (chapter_id, spotify_id))
+
+    def is_unchanged(self, sync_key, snapshot_id, chapters) -> bool:
+        """ True if the playlist snapshot and the chapters of the tonie match the last successful sync """
+        with self.lock:
+            row = self.connection.execute("SELECT snapshot_id, chapters FROM syncs WHERE sync_key = ?", (sync_key,)).fetchone()
+        if row is None or snapshot_id is None:
+            return False
+        return row['snapshot_id'] == snapshot_id and json.loads(row['chapters']) == chapters_fingerprint(chapters)
+
+    def save_sync(self, sync_key, snapshot_id, chapters) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO syncs (sync_key, snapshot_id, chapters) VALUES (?, ?, ?)
+                ON CONFLICT (sync_key) DO UPDATE SET snapshot_id = excluded.snapshot_id, chapters = excluded.chapters
+            """, (sync_key, snapshot_id, json.dumps(chapters_fingerprint(chapters))))
+
+    def get_show(self, show_id) -> Optional[sqlite3.Row]:
+        with self.lock:
+            return self.connection.execute("SELECT * FROM shows WHERE show_id = ?", (show_id,)).fetchone()
+
+    def save_show(self, show_id, name, episodes, window) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO shows (show_id, name, episodes, window) VALUES (?, ?, ?, ?)
+                ON CONFLICT (show_id) DO UPDATE SET name = excluded.name, episodes = excluded.episodes, window = excluded.window
+            """, (show_id, name, json.dumps(episodes), window))
+
+    def get_episode(self, episode_id) -> Optional[sqlite3.Row]:
+        with self.lock:
+            return self.connection.execute("SELECT * FROM episodes WHERE episode_id = ?", (episode_id,)).fetchone()
+
+    def save_episode(self, episode_id, show_name, name, duration_ms) -> None:
+        self.save_episodes(show_name, [(episode_id, name, duration_ms)])
+
+    def save_episodes(self, show_name, episodes) -> None:
+        """ Saves (episode id, name, duration in ms) tuples of a show in one transaction """
+        with self.lock, self.connection:
+            self.connection.executemany("""
+                INSERT INTO episodes (episode_id, show_name, name, duration_ms) VALUES (?, ?, ?, ?)
+                ON CONFLICT (episode_id) DO UPDATE SET show_name = excluded.show_name, name = excluded.name, duration_ms = excluded.duration_ms
+            """, [(episode_id, show_name, name, duration_ms) for episode_id, name, duration_ms in episodes])
+
+    def count_downloads_since(self, timestamp) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM downloads WHERE started_at >= ?", (timestamp,)).fetchone()[0]
+
+    def add_download(self, timestamp) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM downloads WHERE started_at < ?", (timestamp - 86400,))
+            self.connection.execute("INSERT INTO downloads (started_at) VALUES (?)", (timestamp,))
+
+    def get_upload(self, tonie_id, title, file_path) -> Optional[str]:
+        """ file id of an already finished upload of file_path, None if it must be uploaded (again) """
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM uploads WHERE tonie_id = ? AND title = ?", (tonie_id, title)).fetchone()
+        if row is None or row['file_path'] != file_path or row['file_size'] != os.path.getsize(file_path):
+            return None
+        return row['file_id']
+
+    def save_upload(self, tonie_id, title, file_path, file_id) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO uploads (tonie_id, title, file_path, file_size, file_id) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (tonie_id, title) DO UPDATE SET file_path = excluded.file_path,
+                    file_size = excluded.file_size, file_id = excluded.file_id
+            """, (tonie_id, title, file_path, os.path.getsize(file_path), file_id))
+
+    def delete_upload(self, tonie_id, title) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM uploads WHERE tonie_id = ? AND title = ?", (tonie_id, title))
+
+    def close(self) -> None:
+        self.connection.close()
+
+class DownloadStore:
+    """ Audio files in <data-path>/download named by spotify id, the tracks table of the sync state is the index (incl. file sizes) """
+
+    def __init__(self, state, path, max_bytes):
+        self.state = state
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+        if self.state.get_store_version() < STORE_LAYOUT_VERSION:
+            self.migrate()
+            self.state.set_store_version(STORE_LAYOUT_VERSION)
+
+    def migrate(self) -> None:
+        """
+        One time move of older versions' files (named by title) to their spotify id. Index entries whose file is gone are dropped,
+        files without index entry are indexed by their title (see adopt)
+        """
+        sizes = {entry.name: entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file() and not entry.name.endswith(STORE_TEMP_SUFFIXES)}
+        for row in self.state.get_tracks():
+            name = os.path.basename(row['file_path'])
+            if name not in sizes:
+                self.state.delete_track(row['spotify_id'])
+                continue
+            store_name = f"{row['spotify_id']}{os.path.splitext(name)[1]}"
+            if name != store_name:
+                logging.info(f"Moving '{name}' to {store_name}")
+                os.replace(os.path.join(self.path, name), os.path.join(self.path, store_name))
+            size = sizes.pop(name)
+            self.state.set_file_path(row['spotify_id'], os.path.join(self.path, store_name), size)
+        for name, size in sizes.items():
+            self.state.add_legacy_file(name, os.path.splitext(name)[0], os.path.join(self.path, name), size)
+
+    def get_path(self, spotify_id, extension) -> str:
+        return os.path.join(self.path, f"{spotify_id}.{extension}")
+
+    def lookup(self, spotify_id, title, duration_ms) -> Optional[str]:
+        """ Path of the complete stored file of spotify_id (one index query and one stat) """
+        row = self.state.get_track(spotify_id)
+        if row is None:
+            return self.adopt(spotify_id, title, duration_ms)
+        file_fullpath = os.path.join(self.path, os.path.basename(row['file_path']))
+        try:
+            file_size = os.path.getsize(file_fullpath)
+        except OSError:
+            return None
+        if row['file_size'] is not None:
+            return file_fullpath if file_size == row['file_size'] else None
+        # without a stored size only a minimal bitrate tells a complete file from a truncated one
+        return file_fullpath if file_size >= duration_ms / 1000 * MIN_BYTES_PER_SECOND else None
+
+    def adopt(self, spotify_id, title, duration_ms) -> Optional[str]:
+        """ Moves a file of an older version named title (if it seems complete) to the path of spotify_id """
+        row = self.state.get_legacy_file(title)
+        if row is None:
+            return None
+        legacy_fullpath = os.path.join(self.path, os.path.basename(row['file_path']))
+        try:
+            file_size = os.path.getsize(legacy_fullpath)
+        except OSError:
+            self.state.delete_track(row['spotify_id'])
+            return None
+        if file_size < duration_ms / 1000 * MIN_BYTES_PER_SECOND:
+            logging.warning(f"'{os.path.basename(legacy_fullpath)}' seems to be incomplete => downloading it again")
+            return None
+
+        file_fullpath = self.get_path(spotify_id, os.path.splitext(legacy_fullpath)[1].lstrip("."))
+        logging.info(f"Moving '{os.path.basename(legacy_fullpath)}' of an older version to {os.path.basename(file_fullpath)}")
+        os.replace(legacy_fullpath, file_fullpath)
+        self.state.delete_track(row['spotify_id'])
+        self.add(spotify_id, title, file_fullpath, duration_ms)
+        return file_fullpath
+
+    def add(self, spotify_id, title, file_path, duration_ms) -> None:
+        self.state.save_track(spotify_id, title, file_path, duration_ms, get_file_hash(file_path))
+
+    def collect(self) -> None:
+        """ Removes files no playlist references any more (least recently used first) until the store fits into max_bytes """
+        total_size = self.state.get_store_size()
+        evicted = 0
+        if total_size > self.max_bytes:
+            for row in self.state.get_unreferenced_tracks(time.time() - SYNC_REFERENCE_DAYS * 86400):
+                if total_size <= self.max_bytes:
+                    break
+                file_fullpath = os.path.join(self.path, os.path.basename(row['file_path']))
+                logging.debug(f"Evicting {file_fullpath} from the download store")
+                try:
+                    os.unlink(file_fullpath)
+                except FileNotFoundError:
+                    pass
+                self.state.delete_track(row['spotify_id'])
+                total_size -= row['file_size'] or 0
+                evicted += 1
+        logging.info(f"Download store: {total_size / 1024 / 1024:.0f} of {self.max_bytes / 1024 / 1024:.0f} MB, {evicted} unreferenced files removed")
+
+def chapters_fingerprint(chapters) -> list[list[str]]:
+    return [[chapter.id, chapter.title] for chapter in chapters]
+
+def get_file_hash(filename) -> str:
+    """ sha256 of a file, read in 1 MiB blocks """
+    file_hash = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def get_track_title(info) -> str:
+    """ Chapter title (and file name) of a track """
+    return trim_to_128(fix_filename(f"{info.artists[0]} - {info.name}"))
+
+def get_episode_title(podcast_name, episode_name) -> str:
+    """ Chapter title (and file name) of a podcast episode """
+    return trim_to_128(fix_filename(f"{podcast_name} - {episode_name}"))
 
 def trim_to_128(s: str) -> str:
     return s[:128]
 
-def main():
-
-    try:
-        # Create cache path if required
-        if args.data_path is None:
-            args.data_path = os.path.join(os.path.expanduser("~"), ".local", "share", "spoonie")
-        if not os.path.exists(args.data_path):
-            logging.info(f"Creating data folder {args.data_path}")
-            os.makedirs(args.data_path)
-
-        tonie_api = TonieAPI(args.tonie_username, args.tonie_password, args.tonie_timeout)
-        household = next((x for x in tonie_api.get_households() if x.name == args.tonie_household), None)
-        if household is None:
-            raise ValueError(f"Tonie Household '{args.tonie_household}' not found!")
-        creative_tonie = next((x for x in tonie_api.get_all_creative_tonies_by_household(household) if x.name == args.creative_tonie_name), None)
-        if creative_tonie is None:
-            raise ValueError(f"Creative Tonie '{args.creative_tonie_name}' not found!")
-
-        cred_location = get_credentials_location()
-        if Path(cred_location).is_file():
+class SyncPipeline:
+    """ Runs sync jobs concurrently with a bounded number of downloads, encodes and artwork fetches per stage """
+
+    def __init__(self, download_workers, encode_workers, artwork_workers, artwork_cache, governor=None):
+        self.download_slots = threading.BoundedSemaphore(download_workers)
+        self.encode_slots = threading.BoundedSemaphore(encode_workers)
+        self.artwork_pool = ThreadPoolExecutor(max_workers=artwork_workers, thread_name_prefix="artwork")
+        self.artwork_cache = artwork_cache
+        self.governor = governor
+        self.job_pool = ThreadPoolExecutor(max_workers=download_workers + encode_workers, thread_name_prefix="sync")
+        self.failed = False
+
+    def fetch_artwork(self, image_url) -> Future:
+        return self.artwork_pool.submit(self.artwork_cache.get, image_url)
+
+    def run(self, jobs) -> list:
+        """ Runs all jobs (submitted as the jobs iterable yields them) and returns their results in job order (None for skipped or failed jobs), sets failed if any job failed """
+        self.failed = False
+        futures = [self.job_pool.submit(job) for job in jobs]
+        results = []
+        for future in futures:
             try:
-                conf = Session.Configuration.Builder().set_store_credentials(False).build()
-                spotifySession = Session.Builder(conf).stored_file(cred_location).create()
-            except RuntimeError:
-                pass
-        else:
-            raise ValueError("Username / Password auth is no longer supported! Please see docs how to create an `credentials.json`!")
+                results.append(future.result())
+            except Exception:
+                self.failed = True
+                results.append(None)
+        return results
+
+    def close(self) -> None:
+        self.job_pool.shutdown()
+        self.artwork_pool.shutdown()
+        self.artwork_cache.evict()
+
+def fetch_and_convert(spotifySession, pipeline, spotify_id, name, playable_id, duration_ms, file_fullpath, tags=None, artwork=None) -> None:
+    """ Downloads a spotify track / episode via librespot and encodes (and tags) it into file_fullpath """
+    import ffmpy
+
+    part_fullpath = f"{file_fullpath}.part"
+
+    if args.stream_encode:
+        artwork_file = artwork.result() if artwork is not None else None
+        with pipeline.download_slots, pipeline.encode_slots:
+            stream_spotify_track(spotifySession,name,playable_id,duration_ms,part_fullpath,tags,artwork_file,pipeline.governor)
+    else:
+        with pipeline.download_slots:
+            partial_path = download_to_partial(spotifySession,name,playable_id,duration_ms,spotify_id,pipeline.governor)
+        with pipeline.encode_slots:
+            logging.info(f"Finalizing '{name}'...")
+            try:
+                convert_audio_format(partial_path,part_fullpath,tags,artwork.result() if artwork is not None else None)
+            except ffmpy.FFRuntimeError:
+                os.unlink(partial_path)
+                raise
+        if os.path.isfile(part_fullpath):
+            os.unlink(partial_path)
+
+    if os.path.isfile(part_fullpath):
+        finalize_output(part_fullpath, file_fullpath)
+
+def finalize_podcast(pipeline, name, source_fullpath, file_base) -> str:
+    """ Keeps a direct podcast download if the tonie cloud accepts its format, transcodes it with the encode profile otherwise """
+    audio_format = get_audio_format(source_fullpath)
+    if audio_format is not None:
+        logging.info(f"'{name}' is {audio_format} already => no transcoding")
+        file_fullpath = f"{file_base}.{audio_format}"
+        finalize_output(source_fullpath, file_fullpath)
+        return file_fullpath
+
+    file_fullpath = f"{file_base}.{get_encode_profile().extension}"
+    part_fullpath = f"{file_fullpath}.part"
+    with pipeline.encode_slots:
+        logging.info(f"Transcoding '{name}' (unknown podcast format)...")
+        convert_audio_format(source_fullpath, part_fullpath)
+    finalize_output(part_fullpath, file_fullpath)
+    os.unlink(source_fullpath)
+    return file_fullpath
+
+def sync_track(spotifySession, state, pipeline, store, info) -> Optional[tuple[str, str, str, int]]:
+    """ Downloads a playlist track if required, returns (spotify id, title, file, duration in ms) """
+    try:
+        logging.info(f"Processing {info.name} (Id: {info.id})")
+
+        clean_title = get_track_title(info)
+        stored_file = store.lookup(info.id, clean_title, info.duration_ms)
+        if stored_file is not None:
+            logging.info(f"Skipping '{clean_title}' => already downloaded")
+            return info.id, clean_title, stored_file, info.duration_ms
+
+        if not info.is_playable:
+            logging.warning(f"'{clean_title}' is not playable => Skipping!")
+            return None
+
+        profile = get_encode_profile()
+        file_fullpath = store.get_path(info.id, profile.extension)
+        artwork = pipeline.fetch_artwork(info.image_url) if profile.has_cover else None
+        from librespot.metadata import TrackId
+        fetch_and_convert(spotifySession,pipeline,info.id,clean_title,TrackId.from_base62(info.id),info.duration_ms,file_fullpath,get_track_tags(info),artwork)
+        if not os.path.isfile(file_fullpath):
+            raise RuntimeError("Failed to finalize (convert) file!")
+
+        logging.info(f"Done with '{clean_title}'!")
+        store.add(info.id, clean_title, file_fullpath, info.duration_ms)
+        return info.id, clean_title, file_fullpath, info.duration_ms
+
+    except DownloadQuotaExceeded as ex:
+        logging.warning(f"{ex} => '{info.name}' is deferred to a later run")
+        raise
+    except Exception as ex:
+        logging.error(f"Failed to download song {info.name}")
+        logging.critical(ex, exc_info=True)
+        raise
 
-        track_id, album_id, playlist_id, episode_id, show_id, artist_id = regex_input_for_urls(args.playlist)
+def sync_episode(spotifySession, state, pipeline, store, episode) -> Optional[tuple[str, str, str, int]]:
+    """ Downloads a podcast episode if required, returns (spotify id, title, file, duration in ms) """
+    try:
+        logging.info(f"Processing episode with id {episode}")
+        podcast_name, duration_ms, episode_name = get_episode_info(spotifySession, state, episode)
+        clean_title = get_episode_title(podcast_name, episode_name)
 
-        if playlist_id is None and show_id is None:
-            raise ValueError("Supplied playlist is neither a valid playlist or show")
+        stored_file = store.lookup(episode, clean_title, duration_ms)
+        if stored_file is not None:
+            logging.info(f"Skipping '{clean_title}' => already downloaded")
+            return episode, clean_title, stored_file, duration_ms
 
-        show_episodes = []
-        playlist_songs = []
+        resp = invoke_url(spotifySession, 'https://api-partner.spotify.com/pathfinder/v1/query?operationName=getEpisode&variables={"uri":"spotify:episode:' + episode + '"}&extensions={"persistedQuery":{"version":1,"sha256Hash":"224ba0fd89fcfdfb3a15fa2d82a6112d3f4e2ac88fba5c6713de04d1b72cf482"}}')[1]["data"]["episode"]
 
-        download_root = os.path.join(args.data_path,"download")
+        if (len(resp["audio"]["items"]) > 0):
+            direct_download_url = resp["audio"]["items"][-1]["url"]
+        else:
+            logging.warning("No direct download url found")
+            direct_download_url = ""
+
+        if "anon-podcast.scdn.co" in direct_download_url or "audio_preview_url" not in resp:
+            from librespot.metadata import EpisodeId
+            file_fullpath = store.get_path(episode, get_encode_profile().extension)
+            fetch_and_convert(spotifySession,pipeline,episode,clean_title,EpisodeId.from_base62(episode),duration_ms,file_fullpath)
+            if not os.path.isfile(file_fullpath):
+                raise RuntimeError("Failed to finalize (convert) file!")
+        else:
+            # direct podcast downloads keep the extension of their source format
+            with pipeline.download_slots:
+                source_fullpath = download_podcast_directly(direct_download_url, store.get_path(episode, "download"))
+            file_fullpath = finalize_podcast(pipeline, clean_title, str(source_fullpath), os.path.join(store.path, episode))
+
+        logging.info(f"Done with '{clean_title}'!")
+        store.add(episode, clean_title, file_fullpath, duration_ms)
+        return episode, clean_title, file_fullpath, duration_ms
+
+    except DownloadQuotaExceeded as ex:
+        logging.warning(f"{ex} => episode {episode} is deferred to a later run")
+        raise
+    except Exception as ex:
+        logging.error(f"Failed to download episode {episode}")
+        logging.critical(ex, exc_info=True)
+        raise
 
-        if not os.path.exists(download_root):
-            logging.info(f"Creating download folder {download_root}")
-            os.makedirs(download_root)
+def with_retries(func, tries, description):
+    """ Calls func until it succeeds, waiting exponentially longer (plus jitter) between the tries """
+    for attempt in range(tries):
+        try:
+            return func()
+        except Exception as ex:
+            if attempt == tries - 1:
+                raise
+            delay = 2 ** attempt + random.uniform(0, 1)
+            logging.warning(f"{description} failed (try {attempt + 1}): {ex} => retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def upload_file_to_tonie_cloud(tonie_api, file) -> str:
+    """ Uploads a file to the tonie cloud storage, returns its file id """
+    from tonie_api.models import FileUploadRequest
+
+    time_start = time.monotonic()
+    upload_request = FileUploadRequest(**tonie_api._post("file"))
+    mime_type = mimetypes.guess_type(file)
+    with open(file, "rb") as f:
+        r = requests.post(
+            upload_request.request.url,
+            data=upload_request.request.fields,
+            files={"file": (upload_request.request.fields["key"], f, mime_type[0] if mime_type else None)},
+            timeout=180,
+        )
+    r.raise_for_status()
+    metrics.record("upload", time.monotonic() - time_start, os.path.getsize(file))
+    return upload_request.fileId
+
+class TonieUploader:
+    """ Uploads chapters concurrently with retries, finished uploads are journaled so an interrupted run can resume """
+
+    def __init__(self, tonie_api, state, creative_tonie, workers, retries):
+        self.tonie_api = tonie_api
+        self.state = state
+        self.creative_tonie = creative_tonie
+        self.workers = workers
+        self.retries = retries
+        self.chapter_lock = threading.Lock()
+        self.added = []
+        self.failed = False
+
+    def upload_all(self, uploads) -> None:
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="upload") as pool:
+            futures = {pool.submit(self.upload, title, file): title for title, file, _ in uploads}
+            for future, title in futures.items():
+                try:
+                    future.result()
+                except Exception as ex:
+                    logging.error(f"Failed to upload '{title}' to creative tonie")
+                    logging.critical(ex, exc_info=True)
+                    self.failed = True
+
+    def upload(self, title, file) -> None:
+        file_id = self.state.get_upload(self.creative_tonie.id, title, file)
+        if file_id is None:
+            logging.info(f"Uploading '{title}' to creative tonie...")
+            file_id = with_retries(lambda: upload_file_to_tonie_cloud(self.tonie_api, file), self.retries, f"Upload of '{title}'")
+            self.state.save_upload(self.creative_tonie.id, title, file, file_id)
+        else:
+            logging.info(f"'{title}' was already uploaded by an earlier run => only adding the chapter")
+
+        with self.chapter_lock:
+            with_retries(lambda: self.tonie_api.add_chapter_to_tonie(self.creative_tonie, file_id, title), self.retries, f"Adding chapter '{title}'")
+            self.added.append(title)
+
+    def confirm(self, chapters) -> None:
+        """ add_chapter_to_tonie only logs errors of the tonie cloud => an upload is complete once its chapter shows up on the tonie """
+        titles = {chapter.title for chapter in chapters}
+        for title in self.added:
+            if title in titles:
+                self.state.delete_upload(self.creative_tonie.id, title)
+                logging.info(f"Upload of '{title}' complete!")
+            else:
+                logging.error(f"Chapter '{title}' is missing on the creative tonie after adding it => retrying next run")
+                self.failed = True
+
+def get_creative_tonie(tonie_api, household, creative_tonie_name) -> "CreativeTonie":
+    with metrics.phase("reconcile"):
+        creative_tonies = tonie_api.get_all_creative_tonies_by_household(household)
+    creative_tonie = next((x for x in creative_tonies if x.name == creative_tonie_name), None)
+    if creative_tonie is None:
+        raise ValueError(f"Creative Tonie '{creative_tonie_name}' not found!")
+    return creative_tonie
+
+@dataclass
+class ChapterPlan:
+    """ Changes which turn the chapters of a creative tonie into the desired chapter list """
+    keep: list["Chapter"]
+    remove: list["Chapter"]
+    upload: list[tuple[str, str, float]]
+    skip: list[tuple[str, float]]
+    order: list[str]
+    remove_first: bool
+
+def plan_chapters(creative_tonie, desired) -> ChapterPlan:
+    """ Diffs the chapters of the tonie against the desired (title, file, seconds) list """
+    desired_titles = {title for title, _, _ in desired}
+    present = {}
+    remove = []
+    for chapter in creative_tonie.chapters:
+        if chapter.title in desired_titles and chapter.title not in present:
+            present[chapter.title] = chapter
+        else:
+            remove.append(chapter)
+
+    seconds_remaining = creative_tonie.secondsRemaining + sum(chapter.seconds for chapter in remove)
+    chapters_remaining = creative_tonie.chaptersRemaining + len(remove)
+    upload = []
+    skip = []
+    order = []
+    for title, file, seconds in desired:
+        if title in present:
+            order.append(title)
+        elif seconds < seconds_remaining and chapters_remaining > 0:
+            upload.append((title, file, seconds))
+            order.append(title)
+            seconds_remaining -= seconds
+            chapters_remaining -= 1
+        else:
+            skip.append((title, seconds))
+
+    upload_seconds = sum(seconds for _, _, seconds in upload)
+    remove_first = len(remove) > 0 and (upload_seconds >= creative_tonie.secondsRemaining or len(upload) > creative_tonie.chaptersRemaining)
+
+    return ChapterPlan(list(present.values()), remove, upload, skip, order, remove_first)
+
+def log_chapter_plan(plan) -> None:
+    for chapter in plan.remove:
+        logging.info(f"Plan: remove '{chapter.title}' => no longer on the playlist")
+    for title, _, seconds in plan.upload:
+        logging.info(f"Plan: upload '{title}' ({fmt_seconds(seconds)})")
+    for title, seconds in plan.skip:
+        logging.warning(f"Plan: skip '{title}' => Not enough free space on creative tonie! Needed: {seconds}s")
+    if len(plan.skip) > 0:
+        logging.warning(f"Plan: cut-off at '{plan.skip[0][0]}', {len(plan.skip)} chapters ({fmt_seconds(sum(seconds for _, seconds in plan.skip))}) don't fit")
+    logging.info(f"Plan: {len(plan.keep)} chapters already present, final order has {len(plan.order)} chapters")
+
+def apply_chapter_plan(tonie_api, household, creative_tonie, plan, uploader) -> list["Chapter"]:
+    """ Applies a ChapterPlan with as few tonie api calls as possible, returns the final chapters """
+    if plan.remove_first:
+        logging.info(f"Removing {len(plan.remove)} orphaned chapters first to free space...")
+        with metrics.phase("reconcile"):
+            tonie_api.sort_chapter_of_tonie(creative_tonie, plan.keep)
+
+    uploader.upload_all(plan.upload)
+
+    chapters = creative_tonie.chapters
+    known_ids = {chapter.id for chapter in plan.keep + plan.remove}
+    if len(plan.upload) > 0:
+        creative_tonie = get_creative_tonie(tonie_api, household, creative_tonie.name)
+        chapters = creative_tonie.chapters
+        uploader.confirm([chapter for chapter in chapters if chapter.id not in known_ids])
+    elif plan.remove_first:
+        chapters = plan.keep
+
+    keep_ids = {chapter.id for chapter in plan.keep}
+    by_title = {}
+    for chapter in chapters:
+        if chapter.id in keep_ids or (chapter.id not in known_ids and chapter.title not in by_title):
+            by_title[chapter.title] = chapter
+    final_chapters = [by_title[title] for title in plan.order if title in by_title]
+
+    if [chapter.id for chapter in final_chapters] != [chapter.id for chapter in chapters]:
+        logging.info("Updating chapter list (removals / sorting)...")
+        with metrics.phase("reconcile"):
+            tonie_api.sort_chapter_of_tonie(creative_tonie, final_chapters)
+
+    return final_chapters
+
+@dataclass
+class SyncTarget:
+    playlist: str
+    household: str
+    creative_tonie: str
+    latest_episodes: Optional[int] = None
+
+def load_sync_targets(config_file, latest_episodes=None) -> list[SyncTarget]:
+    """
+    Reads the syncs of a config file, e.g.
+    {"syncs": [{"playlist": "https://open.spotify.com/playlist/...", "household": "Sejis Haushalt", "creative_tonie": "Kids", "latest_episodes": 10}]}
+    """
+    with open(config_file, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    targets = []
+    for sync in config.get("syncs", []):
+        missing = [key for key in ("playlist", "household", "creative_tonie") if not sync.get(key)]
+        if len(missing) > 0:
+            raise ValueError(f"Sync {sync} in {config_file} is missing {', '.join(missing)}")
+        targets.append(SyncTarget(sync["playlist"], sync["household"], sync["creative_tonie"], sync.get("latest_episodes", latest_episodes)))
+    if len(targets) == 0:
+        raise ValueError(f"No syncs found in {config_file}")
+    return targets
+
+@dataclass
+class SyncCandidate:
+    spotify_id: str
+    title: str
+    seconds: float
+    job: functools.partial
+
+def get_sync_candidates(spotifySession, state, pipeline, store, playlist_entries, show_episodes, chapter_titles) -> Tuple[list[SyncCandidate], bool]:
+    """
+    Everything a playlist / show wants on the creative tonie (in order) from metadata only, False if some metadata failed.
+    Unplayable tracks (often only for a while, e.g. market restrictions) stay if the tonie has their chapter already
+    """
+    candidates = []
+    queued_ids = set()
+    playlist_episodes = []
+    complete = True
+
+    for entry in playlist_entries:
+        if entry.type == "episode":
+            logging.info(f"Playlist track wit Id {entry.id} seems to be an podcast episode => adding to episode to process later")
+            playlist_episodes.append(entry.id)
+        elif entry.id in queued_ids:
+            continue
+        elif entry.info is None:
+            logging.warning(f"No metadata for {entry.name} (Id: {entry.id}) => Skipping!")
+        elif not entry.info.is_playable and get_track_title(entry.info) not in chapter_titles:
+            logging.warning(f"'{entry.name}' (Id: {entry.id}) is not playable => Skipping!")
+        else:
+            queued_ids.add(entry.id)
+            job = functools.partial(sync_track, spotifySession, state, pipeline, store, entry.info)
+            candidates.append(SyncCandidate(entry.id, get_track_title(entry.info), entry.info.duration_ms / 1000, job))
+
+    for episode in show_episodes + playlist_episodes:
+        if episode in queued_ids:
+            continue
+        queued_ids.add(episode)
+        try:
+            podcast_name, duration_ms, episode_name = get_episode_info(spotifySession, state, episode)
+        except Exception as ex:
+            logging.error(f"Failed to get info of episode {episode}: {ex}")
+            complete = False
+            continue
+        job = functools.partial(sync_episode, spotifySession, state, pipeline, store, episode)
+        candidates.append(SyncCandidate(episode, get_episode_title(podcast_name, episode_name), duration_ms / 1000, job))
+
+    return candidates, complete
+
+def sync_target(tonie_api, spotifySession, state, pipeline, households, store, target) -> bool:
+    """ Syncs one playlist / show to one creative tonie, returns False if something has to be retried next run """
+    household = next((x for x in households if x.name == target.household), None)
+    if household is None:
+        raise ValueError(f"Tonie Household '{target.household}' not found!")
+    creative_tonie = get_creative_tonie(tonie_api, household, target.creative_tonie)
+
+    track_id, album_id, playlist_id, episode_id, show_id, artist_id = regex_input_for_urls(target.playlist)
+
+    if playlist_id is None and show_id is None:
+        raise ValueError(f"Supplied playlist {target.playlist} is neither a valid playlist or show")
+
+    sync_key = f"{playlist_id or show_id}:{creative_tonie.id}"
+    sync_complete = True
+    snapshot_id = None
+
+    if playlist_id is not None:
+        with metrics.phase("playlist"):
+            snapshot_id = get_playlist_snapshot_id(spotifySession, playlist_id)
+        if state.is_unchanged(sync_key, snapshot_id, creative_tonie.chapters):
+            logging.info("Playlist unchanged since last sync and creative tonie is up to date => nothing to do")
+            if not args.dry_run:
+                state.touch_sync_items(sync_key)
+            return True
+
+    show_episodes = []
+    playlist_entries = []
+
+    if playlist_id is not None:
+        playlist_entries = iter_playlist_entries(spotifySession,playlist_id)
+
+    if show_id is not None:
+        with metrics.phase("playlist"):
+            show_episodes = get_show_episodes(spotifySession,state,show_id,target.latest_episodes)
+
+    candidates, sync_complete = get_sync_candidates(spotifySession, state, pipeline, store, playlist_entries, show_episodes,
+                                                   {chapter.title for chapter in creative_tonie.chapters})
+    if not args.dry_run:
+        state.save_sync_items(sync_key, [candidate.spotify_id for candidate in candidates])
+    by_title = {}
+    for candidate in candidates:
+        if candidate.title in by_title:
+            logging.warning(f"'{candidate.title}' is on the playlist more than once => Skipping the duplicate")
+        else:
+            by_title[candidate.title] = candidate
+
+    # plan before downloading: only what fits on the creative tonie (and is not on it yet) gets downloaded
+    logging.info("Planning chapters of creative tonie...")
+    with metrics.phase("reconcile"):
+        plan = plan_chapters(creative_tonie, [(title, None, candidate.seconds) for title, candidate in by_title.items()])
+    log_chapter_plan(plan)
+
+    if args.dry_run:
+        logging.info("Dry run => not downloading / applying the plan")
+        return sync_complete
+
+    downloads = [by_title[title] for title, _, _ in plan.upload]
+    results = pipeline.run(candidate.job for candidate in downloads)
+    if pipeline.failed:
+        sync_complete = False
+
+    download_files = {}
+    for candidate, result in zip(downloads, results):
+        if result is None:
+            continue
+        spotify_id, clean_title, file_fullpath, duration_ms = result
+        download_files[candidate.title] = file_fullpath
+    logging.info("Download completed!")
+
+    missing_titles = {title for title, _, _ in plan.upload if title not in download_files}
+    plan.upload = [(title, download_files[title], seconds) for title, _, seconds in plan.upload if title in download_files]
+    plan.order = [title for title in plan.order if title not in missing_titles]
+    download_ids = {title: candidate.spotify_id for title, candidate in by_title.items()}
+
+    uploader = TonieUploader(tonie_api, state, creative_tonie, args.upload_workers, args.upload_retries)
+    chapters = apply_chapter_plan(tonie_api, household, creative_tonie, plan, uploader)
+    if uploader.failed:
+        sync_complete = False
+    present_titles = {chapter.title for chapter in chapters}
+    absent_titles = [title for title in plan.order if title not in present_titles]
+    if len(absent_titles) > 0:
+        logging.warning(f"{len(absent_titles)} planned chapters are missing on the creative tonie (e.g. '{absent_titles[0]}') => syncing again next run")
+        sync_complete = False
+
+    for chapter in chapters:
+        if chapter.title in download_ids:
+            state.set_chapter_id(download_ids[chapter.title], chapter.id)
+
+    if snapshot_id is not None and sync_complete:
+        state.save_sync(sync_key, snapshot_id, chapters)
+    return sync_complete
+
+def run_syncs(tonie_api, spotifySession, state, pipeline, store, targets) -> list[SyncTarget]:
+    """ Runs all syncs one after another, returns the ones that failed """
+    households = tonie_api.get_households()
+    failed_targets = []
+    for target in targets:
+        logging.info(f"Syncing {target.playlist} => '{target.creative_tonie}' ({target.household})")
+        try:
+            if not sync_target(tonie_api, spotifySession, state, pipeline, households, store, target):
+                logging.warning(f"Sync of {target.playlist} => '{target.creative_tonie}' is incomplete")
+                failed_targets.append(target)
+        except Exception as ex:
+            logging.error(f"Sync of {target.playlist} => '{target.creative_tonie}' failed: {ex}", exc_info=True)
+            failed_targets.append(target)
+    if not args.dry_run:
+        store.collect()
+    return failed_targets
+
+class TriggerHandler(BaseHTTPRequestHandler):
+    """ POST /sync starts a sync of a running daemon """
+
+    def do_POST(self):
+        if self.path != "/sync":
+            self.send_error(404)
+            return
+        self.server.trigger.set()
+        self.send_response(202)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def start_trigger_server(port, trigger) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), TriggerHandler)
+    server.trigger = trigger
+    threading.Thread(target=server.serve_forever, name="trigger", daemon=True).start()
+    logging.info(f"Listening for sync triggers on http://127.0.0.1:{port}/sync")
+    return server
+
+class SpoonieSync:
+    """
+    Syncs spotify playlists / shows to creative tonies, e.g.
 
-        download_titles = {}
-        download_title_lenghts = {}
+        sync = SpoonieSync(create_config(tonie_username="...", tonie_password="...", config="syncs.json"))
+        failed_targets = sync.run()
 
-        if playlist_id is not None:
-            playlist_songs = get_playlist_songs(spotifySession,playlist_id)
+    The config, the spotify api client and the metrics are module wide => they belong to the open SpoonieSync,
+    opening a second one in the same process raises a RuntimeError until the first is closed.
+    """
+    active = None
+    active_lock = threading.Lock()
 
-        if show_id is not None:
-            show_episodes = get_show_episodes(spotifySession,show_id)
+    def __init__(self, config):
+        self.config = config
 
-        if (playlist_songs is not None):
+        # Create cache path if required
+        if config.data_path is None:
+            config.data_path = os.path.join(os.path.expanduser("~"), ".local", "share", "spoonie")
+        if not os.path.exists(config.data_path):
+            logging.info(f"Creating data folder {config.data_path}")
+            os.makedirs(config.data_path)
+
+        if config.config is not None:
+            self.targets = load_sync_targets(config.config, config.latest_episodes)
+        else:
+            self.targets = [SyncTarget(config.playlist, config.tonie_household, config.creative_tonie_name, config.latest_episodes)]
 
-            for song in playlist_songs:
+        self.spotify_session = None
+        self.state = None
+        self.store = None
+        self.pipeline = None
 
-                file_fullpath = ""
-                download_tempfile = tempfile.NamedTemporaryFile(delete=False)
+    def create_tonie_api(self) -> "TonieAPI":
+        from tonie_api.api import TonieAPI
 
-                try:
+        return TonieAPI(self.config.tonie_username, self.config.tonie_password, self.config.tonie_timeout)
 
-                    track_id = song['track']['id']
-
-                    if song['track']['type'] == "episode":
-                        logging.info(f"Playlist track wit Id {track_id} seems to be an podcast episode => adding to episode to process later")
-                        show_episodes.append(track_id)
-                    else:
-
-                        logging.info(f"Processing {song['track']['name']} (Id: {track_id})")
-                        (artists, raw_artists, album_name, name, image_url, release_year, disc_number,track_number, scraped_song_id, is_playable, duration_ms) = get_song_info(spotifySession,track_id)
-
-                        title = f"{artists[0]} - {name}"
-                        clean_title = trim_to_128(fix_filename(title))
-                        filename = f"{clean_title}.mp3"
-                        file_fullpath = os.path.join(download_root,filename)
-
-                        if not os.path.isfile(file_fullpath):
-                            if(is_playable):
-                                track = TrackId.from_base62(track_id)
-                                downloadSpotifyTrack(spotifySession,clean_title,track,duration_ms,download_tempfile,file_fullpath)
-                                logging.info("Finalizing file...")
-                                convert_audio_format(download_tempfile.name,file_fullpath)
-                                if os.path.isfile(file_fullpath):
-                                    logging.info("Done!")
-                                    logging.info("Setting track metadata...")
-                                    set_audio_tags(file_fullpath, artists, name, album_name, release_year, disc_number, track_number)
-                                    set_music_thumbnail(file_fullpath,image_url)
-                                    logging.info("Done!")
-
-                                    download_titles[clean_title] = file_fullpath
-                                    download_title_lenghts[clean_title] = (duration_ms / 1000)
-                                else:
-                                    logging.error("Failed to finalize (convert) file!")
-                            else:
-                                logging.warning(f"'{filename}' is not playable => Skipping!")
-                        else:
-                            logging.info(f"Skipping '{filename}' => already exists")
-
-                            download_titles[clean_title] = file_fullpath
-                            download_title_lenghts[clean_title] = (duration_ms / 1000)
+    def open(self) -> None:
+        """ Configures the module, opens the spotify session (logs in on the first download), the sync state, the download store and the pipeline """
+        global args, spotify_api
+        with SpoonieSync.active_lock:
+            if SpoonieSync.active is not None and SpoonieSync.active is not self:
+                raise RuntimeError("Another SpoonieSync is open in this process")
+            SpoonieSync.active = self
+        args = self.config
+        spotify_api = SpotifyApiClient(self.config.api_rate)
 
-                except Exception as ex:
-                    logging.error(f"Failed to download song {song['track']['name']}")
-                    logging.critical(ex, exc_info=True)
-                finally:
-                    download_tempfile.close()
-                    if os.path.exists(download_tempfile.name):
-                        os.unlink(download_tempfile.name)
-            logging.info("Playlist download completed!")
+        try:
+            self.open_sessions()
+        except BaseException:
+            self.close()
+            raise
 
-        if (show_episodes is not None):
+    def open_sessions(self) -> None:
+        cred_location = get_credentials_location()
+        if not Path(cred_location).is_file():
+            raise ValueError("Username / Password auth is no longer supported! Please see docs how to create an `credentials.json`!")
+        self.spotify_session = SpotifySession(cred_location, os.path.join(args.data_path, TOKEN_FILENAME))
 
-            for episode in show_episodes:
+        self.state = SyncState(os.path.join(args.data_path, STATE_DB_FILENAME))
+        self.store = DownloadStore(self.state, os.path.join(args.data_path,"download"), args.download_quota * 1024 * 1024)
 
-                file_fullpath = ""
-                download_tempfile = tempfile.NamedTemporaryFile(delete=False)
+        artwork_cache = ArtworkCache(os.path.join(args.data_path, ARTWORK_CACHE_FOLDER), args.artwork_cache_size * 1024 * 1024, args.artwork_size, args.artwork_quality)
+        governor = None
+        if args.ban_protection:
+            governor = RateGovernor(self.state, args.ban_bytes_per_second, args.ban_tracks_per_hour, args.ban_tracks_per_day)
+        self.pipeline = SyncPipeline(args.download_workers, args.encode_workers, args.artwork_workers, artwork_cache, governor)
+
+    def close(self) -> None:
+        if self.pipeline is not None:
+            self.pipeline.close()
+            self.pipeline = None
+        if self.state is not None:
+            self.state.close()
+            self.state = None
+        with SpoonieSync.active_lock:
+            if SpoonieSync.active is self:
+                SpoonieSync.active = None
+
+    def sync(self, tonie_api) -> list[SyncTarget]:
+        """ Syncs all targets with the open sessions, returns the failed ones """
+        return run_syncs(tonie_api, self.spotify_session, self.state, self.pipeline, self.store, self.targets)
+
+    def run(self) -> list[SyncTarget]:
+        """ Syncs all targets once and writes the run summary, returns the failed targets """
+        self.open()
+        try:
+            failed_targets = self.sync(self.create_tonie_api())
+            finish_run_metrics(len(self.targets), len(failed_targets))
+        finally:
+            self.close()
+        return failed_targets
+
+    def run_daemon(self) -> None:
+        """ Keeps the sessions open and syncs every interval (only changed playlists do real work) or when triggered """
+        trigger = threading.Event()
+
+        # signal handlers can only be installed by the main thread (and SIGUSR1 is missing on windows)
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: trigger.set())
+        else:
+            logging.info("Not running in the main thread => syncs can't be triggered with SIGUSR1")
 
+        self.open()
+        try:
+            if args.trigger_port is not None:
+                start_trigger_server(args.trigger_port, trigger)
+            tonie_api = None
+            while True:
+                trigger.clear()
                 try:
-
-                    logging.info(f"Processing episode with id {episode}")
-                    podcast_name, duration_ms, episode_name = get_episode_info(spotifySession, episode)
-                    title = f"{podcast_name} - {episode_name}"
-                    resp = invoke_url(spotifySession, 'https://api-partner.spotify.com/pathfinder/v1/query?operationName=getEpisode&variables={"uri":"spotify:episode:' + episode + '"}&extensions={"persistedQuery":{"version":1,"sha256Hash":"224ba0fd89fcfdfb3a15fa2d82a6112d3f4e2ac88fba5c6713de04d1b72cf482"}}')[1]["data"]["episode"]
-
-                    if (len(resp["audio"]["items"]) > 0):
-                        direct_download_url = resp["audio"]["items"][-1]["url"]
-                    else:
-                        logging.warning("No direct download url found")
-                        direct_download_url = ""
-
-                    clean_title = trim_to_128(fix_filename(title))
-                    filename = f"{clean_title}.mp3"
-                    file_fullpath = os.path.join(download_root,filename)
-
-                    if not os.path.isfile(file_fullpath):
-                        if "anon-podcast.scdn.co" in direct_download_url or "audio_preview_url" not in resp:
-                            track = EpisodeId.from_base62(episode)
-                            downloadSpotifyTrack(spotifySession,clean_title,track,duration_ms,download_tempfile,file_fullpath)
-                            logging.info("Finalizing file...")
-                            convert_audio_format(download_tempfile.name,file_fullpath)
-                            if os.path.isfile(file_fullpath):
-
-                                logging.info("Done!")
-                                download_titles[clean_title] = file_fullpath
-                                download_title_lenghts[clean_title] = (duration_ms / 1000)
-                            else:
-                                logging.error("Failed to finalize (convert) file!")
-                        else:
-                            download_podcast_directly(direct_download_url, file_fullpath)
-                    else:
-                        logging.info(f"Skipping '{filename}' => already exists")
-
-                        download_titles[clean_title] = file_fullpath
-                        download_title_lenghts[clean_title] = (duration_ms / 1000)
-
+                    if tonie_api is None:
+                        tonie_api = self.create_tonie_api()
+                    failed_targets = self.sync(tonie_api)
+                    if len(failed_targets) > 0:
+                        # log in again, the tonie cloud session might have expired
+                        tonie_api = None
                 except Exception as ex:
-                    logging.error(f"Failed to download episode {episode_name}")
-                    logging.critical(ex, exc_info=True)
-                finally:
-                    download_tempfile.close()
-                    if os.path.exists(download_tempfile.name):
-                        os.unlink(download_tempfile.name)
-            logging.info("Show download completed!")
-
-        logging.info("Removing orphaned chapters from creative tonie...")
-        chapters_removed = False
-        chapters = creative_tonie.chapters
-        for chapter in chapters:
-            foundOnPlaylist = next((x for x in download_titles.keys() if x == chapter.title), None)
-            if foundOnPlaylist is None:
-                logging.info(f"Removing chapter '{chapter.title}' from creative tonie cause its not longer on the playlist")
-                chapters.remove(chapter)
-                chapters_removed = True
-        if chapters_removed:
-            tonie_api.sort_chapter_of_tonie(creative_tonie,chapters)
-
-        # Refresh tonie
-        creative_tonie = next((x for x in tonie_api.get_all_creative_tonies_by_household(household) if x.name == args.creative_tonie_name), None)
-
-        logging.info("Uploading new songs / chapters...")
-        tonie_seconds_remaining = creative_tonie.secondsRemaining
-        for key, value in download_titles.items():
-            foundOnCreativeTonie = next((x for x in chapters if x.title == key), None)
-            if foundOnCreativeTonie is None:
-                song_playtime = download_title_lenghts[key]
-                if tonie_seconds_remaining - song_playtime > 0:
-                  logging.info(f"Uploading '{key}' to  creative tonie...")
-                  tonie_api.upload_file_to_tonie(creative_tonie,value,key)
-                  tonie_seconds_remaining = tonie_seconds_remaining - song_playtime
-                  logging.info(f"Upload complete! => {tonie_seconds_remaining} free seconds remaining on creative tonie")
-                else:
-                  logging.warning(f" Skipping {key} => Not enough free space on creative tonie! Needed: {song_playtime}s | Free: {tonie_seconds_remaining}s")
-            else:
-                logging.info(f"Skipping '{key}' => already present on creative tonie")
+                    logging.error(f"Sync run failed: {ex}", exc_info=True)
+                    tonie_api = None
+                    failed_targets = self.targets
+                self.pipeline.artwork_cache.evict()
+                finish_run_metrics(len(self.targets), len(failed_targets))
+
+                wait = max(0, args.interval + random.uniform(-args.interval_jitter, args.interval_jitter))
+                logging.info(f"Next check in {fmt_seconds(wait)}")
+                if trigger.wait(wait):
+                    logging.info("Sync triggered")
+        finally:
+            self.close()
 
-        # Refresh tonie
-        creative_tonie = next((x for x in tonie_api.get_all_creative_tonies_by_household(household) if x.name == args.creative_tonie_name), None)
-        chapters = creative_tonie.chapters
+def main():
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s | %(message)s' )
+    config = parse_args()
 
-        logging.info("Sorting chapters...")
-        chapters_sorted = False
-        for num, name in enumerate(download_titles.keys()):
-            oldchapterIndex = next((i for i, item in enumerate(chapters) if item.title == name), -1)
-            if oldchapterIndex != -1 and num != oldchapterIndex:
-                chapters.insert(num, chapters.pop(oldchapterIndex))
-                chapters_sorted = True
-        if chapters_sorted:
-            logging.info("sorting changed...")
-            tonie_api.sort_chapter_of_tonie(creative_tonie,chapters)
+    try:
+        sync = SpoonieSync(config)
+        if config.daemon:
+            sync.run_daemon()
+        else:
+            failed_targets = sync.run()
+            if len(failed_targets) > 0:
+                raise RuntimeError(f"{len(failed_targets)} of {len(sync.targets)} syncs failed")
 
     except Exception as ex:
         logging.critical(ex, exc_info=True)